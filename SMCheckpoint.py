@@ -0,0 +1,305 @@
+#!/usr/bin/env python3.5
+'''
+Checkpoint and resume of State Machine runs.
+A Checkpoint attached to a StateMachine appends one fixed size record to a
+file when a run starts and every time it enters a state:
+    magic, definition fingerprint, run id, id of the run it resumed, state
+    id, previous state id, steps, flags, wall time, seconds since the run
+    started, seconds left to the overall deadline, CRC32
+Records are written with a single unbuffered write to a file opened in
+append mode, so the cost per transition is one system call (plus an fsync
+if sync is True), and a process that dies can at most leave a torn last
+record. Its bytes are cut off when the file is opened again, so the records
+appended after it stay aligned, and a record that is complete but corrupt
+is detected by its CRC and ignored.
+When the process restarts, resume() reads the records back, grouped by run
+id since runs that go on at the same time interleave their records, and
+returns a new Run on the last safe state of the last interrupted run, with
+its history, prevState and remaining overall deadline, instead of starting
+again from the Start State (resume_all returns one for every interrupted
+run). The new Run has a new id and its resumedFrom is the id of the
+interrupted run, which is not resumed again. The handler of that state runs again, so the states that can be
+resumed must have handlers that can be repeated (e.g. puts of absolute
+values). Checkpoints are stale, and not resumed, if the run ended, if they
+are older than maxAge seconds or if they were written by a State Machine
+with different states or transitions.
+When the file grows above maxBytes, it is compacted as a new run starts:
+only the records of the runs in progress, and of the runs they resumed, are
+kept.
+Usage:
+    sm = build_state_machine()
+    sm.checkpoint = Checkpoint('nzsf.ckpt')
+    sm.run(recs, run=sm.checkpoint.resume(sm, recs))
+'''
+
+import os
+import math
+import time
+import zlib
+import struct
+import threading
+import collections
+
+from StateMachineLib import Run
+
+RECORD = struct.Struct('<4sI32s32siiIBxxxdddI')
+MAGIC = b'SMCP'
+# Flags of a record
+RUN_END = 1
+# Seconds after which an interrupted run is not resumed
+MAX_AGE = 5*60
+# Size above which the file is compacted when a new run starts
+MAX_BYTES = 1 << 20
+
+def unpack(chunk):
+    '''
+    Returns the record in chunk as a dictionary, or None if its magic or CRC
+    are wrong
+    '''
+    fields = RECORD.unpack(chunk)
+    if fields[0] != MAGIC or fields[-1] != zlib.crc32(chunk[:-4]):
+        return None
+    return {'fingerprint':fields[1],
+            'run':fields[2].rstrip(b'\0').decode(),
+            'resumedFrom':fields[3].rstrip(b'\0').decode() or None,
+            'state':fields[4],
+            'previous':None if fields[5] < 0 else fields[5],
+            'steps':fields[6], 'end':bool(fields[7] & RUN_END),
+            'time':fields[8], 'elapsed':fields[9], 'remaining':fields[10]}
+
+def parse(data):
+    '''
+    Returns the valid records in data as dictionaries. Records with a wrong
+    magic or CRC, e.g. torn by a crash, are skipped
+    '''
+    size = RECORD.size
+    records = []
+    for offset in range(0, len(data) - size + 1, size):
+        r = unpack(data[offset:offset + size])
+        if r is not None:
+            records.append(r)
+    return records
+
+def group(records):
+    '''
+    Returns an OrderedDict of {run id: records of the run}, in the order the
+    runs started
+    '''
+    runs = collections.OrderedDict()
+    for r in records:
+        runs.setdefault(r['run'], []).append(r)
+    return runs
+
+def fingerprint(sm):
+    '''
+    Returns a CRC32 of the states of sm and of the targets of their
+    transitions, in id order
+    '''
+    text = '\n'.join('{0}:{1}'.format(
+        s.key, ','.join(str(t.targetId) for t in s.transitions))
+                     for s in sm.stateList)
+    return zlib.crc32(text.encode())
+
+class Checkpoint:
+    '''
+    Append-only checkpoint file of the runs of a StateMachine.
+    Atributes:
+        -path: Checkpoint file
+        -safe: Names of the states a run can be resumed on. If None any
+        state can. A run interrupted on another state is resumed on the
+        last safe state it went through
+        -maxAge: Seconds after which a checkpoint is stale
+        -sync: If True every record is flushed to disk with fsync
+        -maxBytes: Size above which the file is compacted when a new run
+        starts
+        -live: Dictionary of {run id: wall time of its last record} of the
+        runs in progress, whose records are kept by compact
+    Methods:
+        -save: Appends the record of a run, called by the StateMachine when
+        the run starts and on every state it enters
+        -records: Returns the valid records of the file, oldest first, as
+        dictionaries
+        -runs: Returns the records of the file grouped by run id
+        -interrupted: Returns a list with the (records of the steps up to
+        the last safe state, last record) of every run that can be resumed,
+        in the order they were interrupted
+        -resume: Returns a new Run that continues the last interrupted run
+        of the file, or None if there is no run to resume
+        -make_run: Returns a new Run that continues an interrupted run,
+        logging a run_resume event with its resumedFrom
+        -resume_all: Returns a new Run for every interrupted run of the
+        file, in the order they were interrupted
+        -compact: Rewrites the file with the records of the live runs only
+        -close: Closes the file
+    '''
+    def __init__(self, path, safe=None, maxAge=MAX_AGE, sync=False,
+                 maxBytes=MAX_BYTES):
+        self.path = path
+        self.safe = None if safe is None else set(s.upper() for s in safe)
+        self.maxAge = maxAge
+        self.sync = sync
+        self.maxBytes = maxBytes
+        self.compactSize = maxBytes
+        self.live = {}
+        # Runs on different threads save at the same time
+        self.lock = threading.Lock()
+        self.fd = self.open()
+        self.sm = None
+        self.fingerprintValue = None
+
+    def open(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # Cut off a record torn by a crash, or every later record would be
+        # misaligned
+        size = os.fstat(fd).st_size
+        if size % RECORD.size:
+            os.ftruncate(fd, size - size % RECORD.size)
+        return fd
+
+    def fingerprint(self, sm):
+        if sm is not self.sm:
+            self.sm = sm
+            self.fingerprintValue = fingerprint(sm)
+        return self.fingerprintValue
+
+    def save(self, sm, run, end=False):
+        now = sm.clock.now()
+        wall = time.time()
+        remaining = math.nan if run.deadline is None else run.deadline - now
+        data = RECORD.pack(MAGIC, self.fingerprint(sm),
+                           run.runId.encode()[:32],
+                           (run.resumedFrom or '').encode()[:32], run.state,
+                           -1 if run.previous is None else run.previous,
+                           run.steps, RUN_END if end else 0, wall,
+                           now - run.startTime, remaining, 0)
+        data = data[:-4] + struct.pack('<I', zlib.crc32(data[:-4]))
+        with self.lock:
+            if run.runId not in self.live and \
+                    os.fstat(self.fd).st_size > self.compactSize:
+                self.compact()
+            if end:
+                self.live.pop(run.runId, None)
+            else:
+                self.live[run.runId] = wall
+            os.write(self.fd, data)
+        if self.sync:
+            os.fsync(self.fd)
+
+    def records(self):
+        with open(self.path, 'rb') as f:
+            return parse(f.read())
+
+    def runs(self):
+        return group(self.records())
+
+    def compact(self):
+        # Called with the lock held. Runs that raised never wrote their end
+        # record, so they are dropped once they are stale
+        wall = time.time()
+        self.live = dict((k, t) for k, t in self.live.items()
+                         if wall - t <= self.maxAge)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        size = RECORD.size
+        chunks = [data[o:o + size]
+                  for o in range(0, len(data) - size + 1, size)]
+        # Records are matched on the raw bytes of their run id, so the ones
+        # that are dropped, most of the file, are never unpacked
+        keep = set()
+        pending = [k.encode()[:32].ljust(32, b'\0') for k in self.live]
+        while pending:
+            key = pending.pop()
+            if key in keep:
+                continue
+            keep.add(key)
+            # The history of a resumed run starts in the run it resumed
+            for c in chunks:
+                r = unpack(c) if c[8:40] == key else None
+                if r is not None:
+                    if r['resumedFrom'] is not None:
+                        pending.append(c[40:72])
+                    break
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(b''.join(c for c in chunks
+                             if c[8:40] in keep and unpack(c) is not None))
+            if self.sync:
+                os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        os.close(self.fd)
+        self.fd = self.open()
+        # Live runs may still fill the file, so it isn't compacted again
+        # until it doubles
+        self.compactSize = max(self.maxBytes, 2*os.fstat(self.fd).st_size)
+
+    def interrupted(self, sm):
+        if not(sm.stateList):
+            sm.compile()
+        stateList = sm.stateList
+        fp = self.fingerprint(sm)
+        wall = time.time()
+        runs = self.runs()
+        superseded = set(saved[0]['resumedFrom'] for saved in runs.values())
+        histories = {}
+        found = []
+        for runId, saved in runs.items():
+            # Records of the run by step, starting with the steps of the run
+            # it resumed. A resumed run writes its steps again from the
+            # state it was resumed on
+            steps = list(histories.get(saved[0]['resumedFrom'], ()))
+            for r in saved:
+                del steps[r['steps']:]
+                steps.append(r)
+            histories[runId] = steps
+            last = saved[-1]
+            if (last['end'] or runId in superseded or last['fingerprint'] != fp
+                    or wall - last['time'] > self.maxAge):
+                continue
+            steps = list(steps)
+            while steps and self.safe is not None and \
+                    stateList[steps[-1]['state']].key not in self.safe:
+                steps.pop()
+            if steps:
+                found.append((steps, last))
+        found.sort(key=lambda f: f[1]['time'])
+        return found
+
+    def make_run(self, sm, records, steps, last):
+        # The time left to the deadline comes from the last record of the
+        # run, which may be after its last safe state
+        stateList = sm.stateList
+        saved = steps[-1]
+        now = sm.clock.now()
+        deadline = None
+        if not(math.isnan(last['remaining'])):
+            # The time the process was down counts against the deadline
+            deadline = now + last['remaining'] - (time.time() - last['time'])
+        run = Run(sm.log.new_run(), saved['state'], now - saved['elapsed'],
+                  deadline, records, sm.log)
+        run.resumedFrom = last['run']
+        run.history = [r['state'] for r in steps]
+        run.previous = saved['previous']
+        run.steps = saved['steps']
+        if run.previous is not None:
+            run.records['Input']['prevState'] = stateList[run.previous].name
+        sm.log.emit('run_resume',
+                    'Resuming recovery on {0}'.format(stateList[run.state].key),
+                    run=run.runId, resumedFrom=run.resumedFrom, clock=now,
+                    state=stateList[run.state].name)
+        return run
+
+    def resume(self, sm, records):
+        found = self.interrupted(sm)
+        if not(found):
+            return None
+        return self.make_run(sm, records, *found[-1])
+
+    def resume_all(self, sm, records):
+        return [self.make_run(sm, records, steps, last)
+                for steps, last in self.interrupted(sm)]
+
+    def close(self):
+        os.close(self.fd)
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3.5
+'''
+Structured transition conditions.
+A Condition is built from expression nodes instead of a lambda, so the
+engine can see which inputs it reads and evaluate it either on one snapshot
+or, with NumPy, on the snapshots of many machines at once:
+    Condition(Or(Compare('>', Abs(Input('voltAz')), Const(0.5)),
+                 Compare('>', Abs(Input('voltEl')), Const(0.5))))
+or, in the condition language, parsed once when the State is built:
+    parse('abs(voltAz) > 0.5 or abs(voltEl) > 0.5')
+The language is a Python expression limited to input names, numbers and
+strings, comparisons, abs(), and, or and not. Conditions, or strings in that
+language, are used in the transitions array in place of the lambda, and their
+inputs don't need to be listed in the row.
+BatchEvaluator computes the next transition of N machines that are in the
+same State from a dictionary of columns {input name: array of N values}:
+    batch = BatchEvaluator(state)
+    rows = batch.decide(snapshot_columns(snapshots, state.inputNames),
+                        len(snapshots))
+numpy is imported when a batch is evaluated.
+'''
+
+import ast
+import operator
+import functools
+
+from StateMachineLib import InitializationError
+
+COMPARISONS = {'<':operator.lt, '<=':operator.le, '>':operator.gt,
+               '>=':operator.ge, '==':operator.eq, '!=':operator.ne}
+
+AST_COMPARISONS = {ast.Lt:'<', ast.LtE:'<=', ast.Gt:'>', ast.GtE:'>=',
+                   ast.Eq:'==', ast.NotEq:'!='}
+
+class Node:
+    '''
+    Base class of the expression nodes.
+    Methods:
+        -inputs: Returns the set of input names read by the expression
+        -compile: Returns a function f(snapshot) that evaluates the
+        expression on one snapshot
+        -vector: Evaluates the expression on a dictionary of columns,
+        returning an array (or a scalar for constant expressions)
+    '''
+    def inputs(self):
+        names = set()
+        for a in self.args:
+            names |= a.inputs()
+        return names
+
+class Input(Node):
+    '''
+    Value of an input: the value attribute of PVs and Samples, or the input
+    itself for plain values such as prevState
+    '''
+    args = ()
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def inputs(self):
+        return {self.name}
+
+    def compile(self):
+        name = self.name
+
+        def value(snap):
+            v = snap[name]
+            return getattr(v, 'value', v)
+        return value
+
+    def vector(self, cols):
+        return cols[self.name]
+
+class Const(Node):
+    args = ()
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return repr(self.value)
+
+    def compile(self):
+        value = self.value
+        return lambda snap: value
+
+    def vector(self, cols):
+        return self.value
+
+class Abs(Node):
+    def __init__(self, arg):
+        self.args = (arg,)
+
+    def __repr__(self):
+        return 'abs({!r})'.format(self.args[0])
+
+    def compile(self):
+        f = self.args[0].compile()
+        return lambda snap: abs(f(snap))
+
+    def vector(self, cols):
+        return abs(self.args[0].vector(cols))
+
+class Compare(Node):
+    def __init__(self, op, left, right):
+        if op not in COMPARISONS:
+            raise InitializationError('Unknown comparison {}'.format(op))
+        self.op = op
+        self.args = (left, right)
+
+    def __repr__(self):
+        return '{0!r} {1} {2!r}'.format(self.args[0], self.op, self.args[1])
+
+    def compile(self):
+        fn = COMPARISONS[self.op]
+        left = self.args[0].compile()
+        right = self.args[1].compile()
+        return lambda snap: fn(left(snap), right(snap))
+
+    def vector(self, cols):
+        return COMPARISONS[self.op](self.args[0].vector(cols),
+                                    self.args[1].vector(cols))
+
+class And(Node):
+    def __init__(self, *args):
+        self.args = args
+
+    def __repr__(self):
+        return '({})'.format(' and '.join(repr(a) for a in self.args))
+
+    def compile(self):
+        fs = [a.compile() for a in self.args]
+
+        def test(snap):
+            for f in fs:
+                if not(f(snap)):
+                    return False
+            return True
+        return test
+
+    def vector(self, cols):
+        import numpy as np
+        result = True
+        for a in self.args:
+            result = np.logical_and(result, a.vector(cols))
+        return result
+
+class Or(Node):
+    def __init__(self, *args):
+        self.args = args
+
+    def __repr__(self):
+        return '({})'.format(' or '.join(repr(a) for a in self.args))
+
+    def compile(self):
+        fs = [a.compile() for a in self.args]
+
+        def test(snap):
+            for f in fs:
+                if f(snap):
+                    return True
+            return False
+        return test
+
+    def vector(self, cols):
+        import numpy as np
+        result = False
+        for a in self.args:
+            result = np.logical_or(result, a.vector(cols))
+        return result
+
+class Not(Node):
+    def __init__(self, arg):
+        self.args = (arg,)
+
+    def __repr__(self):
+        return 'not {!r}'.format(self.args[0])
+
+    def compile(self):
+        f = self.args[0].compile()
+        return lambda snap: not(f(snap))
+
+    def vector(self, cols):
+        import numpy as np
+        return np.logical_not(self.args[0].vector(cols))
+
+class Condition:
+    '''
+    Transition condition built from an expression node. It is called like
+    the condition lambdas, cond(inputNames, snapshot), and ignores the input
+    names of the row, since the expression names its inputs.
+    Atributes:
+        -expr: Expression node
+        -text: Source of the condition, if it was parsed
+        -inputs: Sorted list of the input names read by the expression
+        -test: Compiled function test(snapshot)
+    Methods:
+        -vector: Evaluates the condition on a dictionary of columns with n
+        values each, returning a boolean array of length n
+    '''
+    def __init__(self, expr):
+        self.expr = expr
+        self.text = None
+        self.inputs = sorted(expr.inputs())
+        self.test = expr.compile()
+
+    def __repr__(self):
+        return 'Condition({!r})'.format(self.text or self.expr)
+
+    def __call__(self, names, snap):
+        return self.test(snap)
+
+    def vector(self, cols, n):
+        import numpy as np
+        result = np.asarray(self.expr.vector(cols), bool)
+        return np.broadcast_to(result, (n,))
+
+ALWAYS = Condition(Const(True))
+
+def to_node(tree, text):
+    '''
+    Converts a parsed expression into expression nodes, raising
+    InitializationError for anything outside the condition language
+    '''
+    if isinstance(tree, ast.BoolOp):
+        args = [to_node(v, text) for v in tree.values]
+        return And(*args) if isinstance(tree.op, ast.And) else Or(*args)
+    if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, ast.Not):
+        return Not(to_node(tree.operand, text))
+    if isinstance(tree, ast.Compare):
+        pairs = []
+        left = to_node(tree.left, text)
+        for op, comp in zip(tree.ops, tree.comparators):
+            if type(op) not in AST_COMPARISONS:
+                break
+            right = to_node(comp, text)
+            pairs.append(Compare(AST_COMPARISONS[type(op)], left, right))
+            left = right
+        else:
+            # a < b < c is a < b and b < c
+            return pairs[0] if len(pairs) == 1 else And(*pairs)
+    if (isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name)
+            and tree.func.id == 'abs' and len(tree.args) == 1
+            and not(tree.keywords)):
+        return Abs(to_node(tree.args[0], text))
+    if isinstance(tree, ast.Name):
+        return Input(tree.id)
+    try:
+        # Numbers (also negative ones), strings, True and False
+        value = ast.literal_eval(tree)
+    except ValueError:
+        value = None
+    if isinstance(value, (bool, int, float, str)):
+        return Const(value)
+    raise InitializationError('Unsupported {0} in condition {1!r}'.format(
+        type(tree).__name__, text))
+
+@functools.lru_cache(maxsize=1024)
+def parse(text):
+    '''
+    Parses a condition written in the condition language and returns its
+    Condition, raising InitializationError if it is not valid. Conditions
+    are cached, so tables built many times are parsed once
+    '''
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as err:
+        raise InitializationError('Invalid condition {0!r}: {1}'.format(
+            text, err.msg))
+    cond = Condition(to_node(tree.body, text))
+    cond.text = text
+    return cond
+
+def snapshot_columns(snapshots, names):
+    '''
+    Turns a list of snapshots (see take_snapshot) into a dictionary of
+    columns {name: array}, one value per snapshot
+    '''
+    import numpy as np
+    cols = {}
+    for n in names:
+        cols[n] = np.array([getattr(s[n], 'value', s[n]) for s in snapshots])
+    return cols
+
+class BatchEvaluator:
+    '''
+    Evaluates the transitions of a State for many machines, or many samples
+    of one machine, in one vectorized pass per transition. Every condition
+    of the State must be a Condition.
+    Methods:
+        -decide: Returns an array with the index in state.transitions of the
+        first transition whose condition is met for each of the n entries of
+        the columns, or -1 if none is. n is given explicitly, since a state
+        whose conditions read no inputs gets no columns. Error transitions
+        are returned as any other row; taking them only after their timeout
+        is left to the caller
+        -targets: Same as decide, returning the next state names (None where
+        no transition is met)
+    '''
+    def __init__(self, state):
+        for t in state.transitions:
+            if not(isinstance(t.cond, Condition)):
+                raise InitializationError(
+                    'Transition to {0} in {1} state is not a Condition'.format(
+                        t.name, state.name))
+        self.state = state
+        self.transitions = state.transitions
+
+    def decide(self, cols, n):
+        import numpy as np
+        choice = np.full(n, -1)
+        for k, t in enumerate(self.transitions):
+            pending = choice < 0
+            if not(pending.any()):
+                break
+            choice[pending & t.cond.vector(cols, n)] = k
+        return choice
+
+    def targets(self, cols, n):
+        names = [t.name for t in self.transitions]
+        return [names[k] if k >= 0 else None for k in self.decide(cols, n)]
+
+if __name__ == '__main__':
+    pass
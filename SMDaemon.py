@@ -0,0 +1,195 @@
+#!/usr/bin/env python3.5
+'''
+Resident service mode for the State Machine library.
+A Daemon connects the channels of the records once, keeps them connected,
+and monitors the trigger inputs of a recovery. When a fault is raised (any
+trigger input goes from false to true) and still holds after the debounce
+time, a new run of the State Machine is started on a worker thread. The
+machine definition is built once, and each recovery is a new Run of it (see
+StateMachine.new_run), so a recovery starts the debounce time plus a few
+milliseconds after the fault, instead of after the interpreter startup,
+imports and connections of a new process. Corrective actions are taken by
+the state handlers, so they only run if the State Machine has runHandlers
+set; otherwise each recovery is a dry run that only follows the transitions.
+Usage:
+    sm = build_state_machine()
+    sm.runHandlers = True
+    daemon = Daemon(sm, make_records(), ('nzsAz', 'nzsEl'))
+    daemon.serve_forever()
+or python3 nzsfRecovery.py --daemon --run-handlers
+'''
+
+import sys
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+from StateMachineLib import InitializationError, CONNECT_TIME
+
+# Seconds a fault has to hold before a recovery starts
+DEBOUNCE_TIME = 0.5
+# Maximum number of recoveries running at the same time
+MAX_RUNS = 1
+
+class Daemon:
+    '''
+    Runs a StateMachine every time a fault is raised on its trigger inputs.
+    Atributes:
+        -sm: StateMachine of the recovery, validated once by start
+        -records: Input/output dictionary shared by all the runs
+        -triggers: Names of the inputs that raise the fault
+        -debounce: Seconds the fault has to hold before a run starts. Faults
+        that clear before are ignored
+        -maxRuns: Maximum number of runs at the same time. Faults raised
+        while it is reached are ignored
+        -connTimeout: Maximum time start waits for the channels to connect
+        -running: Dictionary of {runId: Run} of the runs in progress
+        -results: Deque with the (runId, end state name or exception) of the
+        latest finished runs
+        -faults, ignored: Number of faults raised, and of faults that didn't
+        start a run because they didn't hold or maxRuns was reached
+    Methods:
+        -start: Validates the State Machine, connects the channels and
+        subscribes to the trigger inputs, raising InitializationError if any
+        of them fails. If the State Machine has a checkpoint, the runs that
+        were interrupted when the daemon last stopped are resumed first, as
+        many as maxRuns allows
+        -stop: Removes the subscriptions, waits for the running runs and
+        stops the workers
+        -serve_forever: Calls start and blocks until stop is called or the
+        process is interrupted
+        -faulted: Returns True if any trigger input is set
+        -launch: Starts a run now, or continues the given Run, if maxRuns
+        allows it, and returns its Future (None if it was ignored)
+    '''
+    def __init__(self, sm, records, triggers, debounce=DEBOUNCE_TIME,
+                 maxRuns=MAX_RUNS, connTimeout=CONNECT_TIME, history=100):
+        self.sm = sm
+        self.records = records
+        self.triggers = tuple(triggers)
+        self.debounce = debounce
+        self.maxRuns = maxRuns
+        self.connTimeout = connTimeout
+        self.running = {}
+        self.results = collections.deque(maxlen=history)
+        self.faults = 0
+        self.ignored = 0
+        self.active = False
+        self.pending = None
+        self.monitors = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=maxRuns)
+
+    def start(self):
+        inpt = self.records['Input']
+        for n in self.triggers:
+            if not(hasattr(inpt.get(n), 'add_callback')):
+                raise InitializationError(
+                    'Trigger {} is not an input channel'.format(n))
+        self.sm.validate(self.records)
+        self.sm.connect(self.records, self.connTimeout)
+        self.stopped.clear()
+        if self.sm.checkpoint is not None:
+            for run in self.sm.checkpoint.resume_all(self.sm, self.records):
+                self.active = True
+                self.launch(run)
+        for n in self.triggers:
+            pv = inpt[n]
+            self.monitors.append((pv, pv.add_callback(self.on_trigger)))
+        self.sm.log.emit('daemon_start',
+                         'Waiting for faults on {0}{1}'.format(
+                             ', '.join(self.triggers),
+                             '' if self.sm.runHandlers else ' (dry run)'),
+                         triggers=self.triggers,
+                         runHandlers=self.sm.runHandlers)
+        # A fault already present when the daemon starts is a rising edge
+        self.on_trigger()
+
+    def stop(self):
+        for pv, index in self.monitors:
+            pv.remove_callback(index)
+        self.monitors = []
+        with self.lock:
+            if self.pending is not None:
+                self.pending.cancel()
+                self.pending = None
+        self.executor.shutdown(wait=True)
+        self.sm.log.emit('daemon_stop', 'Daemon stopped', faults=self.faults,
+                         ignored=self.ignored)
+        self.sm.log.flush()
+        self.stopped.set()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not(self.stopped.wait(1.0)):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+    def faulted(self):
+        inpt = self.records['Input']
+        for n in self.triggers:
+            if getattr(inpt[n], 'value', None):
+                return True
+        return False
+
+    def on_trigger(self, **kw):
+        # Runs on the monitor threads, so it only schedules the work
+        fault = self.faulted()
+        with self.lock:
+            rising = fault and not(self.active)
+            self.active = fault
+            if not(rising) or self.pending is not None:
+                return
+            self.faults += 1
+            if self.debounce > 0:
+                self.pending = threading.Timer(self.debounce, self.confirm)
+                self.pending.daemon = True
+                self.pending.start()
+                return
+        self.launch()
+
+    def confirm(self):
+        with self.lock:
+            self.pending = None
+        if not(self.faulted()):
+            self.ignored += 1
+            self.sm.log.emit('fault_ignored', reason='cleared')
+            return
+        self.launch()
+
+    def launch(self, run=None):
+        with self.lock:
+            if len(self.running) >= self.maxRuns:
+                self.ignored += 1
+                self.sm.log.emit('fault_ignored', reason='maxRuns')
+                return None
+            resumed = run is not None
+            if not(resumed):
+                run = self.sm.new_run(self.records)
+            self.running[run.runId] = run
+        if not(resumed):
+            self.sm.log.emit('fault', 'Fault detected, starting recovery',
+                             run=run.runId)
+        return self.executor.submit(self.run_recovery, run)
+
+    def run_recovery(self, run):
+        # Worker threads must attach to the shared context before using CA
+        epics = sys.modules.get('epics')
+        if epics is not None:
+            epics.ca.use_initial_context()
+        try:
+            result = self.sm.run_sequence(self.records, run=run)
+        except Exception as err:
+            self.sm.log.emit('error', 'Recovery {0} failed: {1!r}'.format(
+                run.runId, err), run=run.runId)
+            result = err
+        with self.lock:
+            del self.running[run.runId]
+            self.results.append((run.runId, result))
+        return result
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3.5
+'''
+Structured event log for the State Machine library.
+Events are timestamped dictionaries, e.g.
+    {'seq': 12, 'time': 1700000000.1, 'event': 'transition',
+     'run': '6553f100-1a2b-3', 'state': 'az_assert', 'target': 'rec_error',
+     'text': 'Error: Azimuth Drive did not assert', ...}
+emit() only appends the event to a bounded buffer and never blocks; a
+background writer hands the buffered events to the sinks. If the buffer is
+full the event is dropped and counted, so a slow terminal or disk can't stall
+a transition decision. Every event of a run carries the same run id, so the
+events of many runs written to one file can be told apart afterwards.
+Usage:
+    log = EventLog([StdoutSink(), RotatingFileSink('nzsf.jsonl')])
+    sm = StateMachine(log=log)
+'''
+
+import os
+import sys
+import time
+import json
+import atexit
+import threading
+import itertools
+import collections
+
+# Period of the background writer
+FLUSH_INTERVAL = 0.05
+# Maximum number of buffered events
+LOG_CAPACITY = 4096
+
+def to_json(record):
+    return json.dumps(record, default=repr, separators=(',', ':'))
+
+class StdoutSink:
+    '''
+    Writes the text of the events that have one, which are the messages the
+    State Machine used to print. If verbose is True every event is written,
+    as JSON when it has no text.
+    '''
+    def __init__(self, stream=None, verbose=False):
+        self.stream = stream
+        self.verbose = verbose
+
+    def write(self, record):
+        text = record.get('text')
+        if text is None:
+            if not(self.verbose):
+                return
+            text = to_json(record)
+        # Looked up on every write, so redirections of sys.stdout apply
+        stream = self.stream or sys.stdout
+        stream.write(text + '\n')
+
+    def flush(self):
+        (self.stream or sys.stdout).flush()
+
+    def close(self):
+        self.flush()
+
+class JSONLinesSink:
+    '''
+    Writes every event as one JSON object per line to a stream, or to a file
+    opened in append mode if path is given
+    '''
+    def __init__(self, path=None, stream=None):
+        self.path = path
+        if path is not None:
+            stream = open(path, 'a')
+        self.stream = stream
+
+    def write(self, record):
+        self.stream.write(to_json(record) + '\n')
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        if self.path is not None:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+class RotatingFileSink(JSONLinesSink):
+    '''
+    JSONLinesSink that rotates its file when it reaches maxBytes, keeping up
+    to backups old files named path.1 (newest) to path.N (oldest)
+    '''
+    def __init__(self, path, maxBytes=1 << 20, backups=3):
+        JSONLinesSink.__init__(self, path)
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.size = self.stream.tell()
+
+    def write(self, record):
+        line = to_json(record) + '\n'
+        if self.size and self.size + len(line) > self.maxBytes:
+            self.rotate()
+        self.stream.write(line)
+        self.size += len(line)
+
+    def rotate(self):
+        self.stream.close()
+        for i in range(self.backups - 1, 0, -1):
+            old = '{0}.{1}'.format(self.path, i)
+            if os.path.exists(old):
+                os.replace(old, '{0}.{1}'.format(self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        self.stream = open(self.path, 'w')
+        self.size = 0
+
+class EventLog:
+    '''
+    Bounded buffer of events plus the background writer that sends them to
+    the sinks.
+    Atributes:
+        -sinks: List of objects with write(record), flush() and close()
+        methods
+        -capacity: Maximum number of buffered events
+        -dropped: Number of events dropped because the buffer was full
+        -sinkErrors: Number of writes and flushes that raised in a sink. The
+        first error of each sink is reported on stderr, and the count when
+        the log is closed
+    Methods:
+        -emit: Buffers an event, starting the writer on first use. Never
+        blocks
+        -new_run: Returns a new run id
+        -flush: Writes all the buffered events, blocking the caller until
+        they reach the sinks
+        -close: Stops the writer, flushes and closes the sinks
+    '''
+    def __init__(self, sinks=None, capacity=LOG_CAPACITY,
+                 flushInterval=FLUSH_INTERVAL):
+        if sinks is None:
+            sinks = [StdoutSink()]
+        self.sinks = list(sinks)
+        self.capacity = capacity
+        self.flushInterval = flushInterval
+        # deque append and popleft are atomic, so emit takes no lock
+        self.buffer = collections.deque()
+        self.seq = itertools.count()
+        self.runs = itertools.count(1)
+        self.dropped = 0
+        self.sinkErrors = 0
+        self.failedSinks = set()
+        self.writing = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def emit(self, event, text=None, **fields):
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        record = {'seq':next(self.seq), 'time':time.time(), 'event':event}
+        record.update(fields)
+        if text is not None:
+            record['text'] = text
+        self.buffer.append(record)
+        if self.thread is None:
+            self.start()
+
+    def new_run(self):
+        return '{0:x}-{1:x}-{2}'.format(int(time.time()), os.getpid(),
+                                        next(self.runs))
+
+    def start(self):
+        with self.writing:
+            if self.thread is not None:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run_writer,
+                                           daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def run_writer(self):
+        while self.running:
+            time.sleep(self.flushInterval)
+            self.flush()
+
+    def flush(self):
+        with self.writing:
+            buf = self.buffer
+            while buf:
+                record = buf.popleft()
+                for s in self.sinks:
+                    try:
+                        s.write(record)
+                    except Exception as err:
+                        self.sink_error(s, err)
+            for s in self.sinks:
+                try:
+                    s.flush()
+                except Exception as err:
+                    self.sink_error(s, err)
+
+    def sink_error(self, sink, err):
+        # A failing sink must not stop the others, but it can't fail quietly
+        self.sinkErrors += 1
+        if id(sink) not in self.failedSinks:
+            self.failedSinks.add(id(sink))
+            sys.stderr.write('EventLog: {0} failed: {1!r}\n'.format(
+                type(sink).__name__, err))
+
+    def close(self):
+        atexit.unregister(self.close)
+        self.running = False
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+        for s in self.sinks:
+            s.close()
+        if self.sinkErrors:
+            sys.stderr.write('EventLog: {0} sink errors\n'.format(
+                self.sinkErrors))
+
+if __name__ == '__main__':
+    pass
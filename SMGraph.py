@@ -0,0 +1,198 @@
+#!/usr/bin/env python3.5
+'''
+Static analysis of the transition graph of a StateMachine.
+StateGraph numbers the states in the order they were added and keeps, for
+each state id, the tuple of the ids of the states it can transition to.
+analyze() finds, before anything runs:
+    -unknown: transitions to states that don't exist (errors)
+    -deadEnds: states that are not End States and have no transitions
+    (errors)
+    -trapped: states reachable from the Start State that can't reach any
+    End State, e.g. cycles with no exit (errors)
+    -unreachable: states that can't be reached from the Start State
+    (warnings)
+    -cycles: groups of states that can transition among themselves forever,
+    e.g. follow_on and follow_off (warnings)
+StateMachine.validate runs the analysis and raises InitializationError for
+the errors. The graph can be exported with to_dot() or to_json():
+    python3 SMGraph.py > nzsf.dot
+'''
+
+import json
+import collections
+
+from StateMachineLib import InitializationError
+
+class StateGraph:
+    '''
+    Integer indexed transition graph of a StateMachine.
+    Atributes:
+        -names: State names, indexed by state id
+        -ids: Dictionary of {upper case state name: state id}
+        -edges: Tuple of the target ids of each state, in table order and
+        without repetitions
+        -start: Id of the Start State, None if there is none
+        -ends: Set of the ids of the End States
+        -unknown: List of (state, target name) of the transitions to unknown
+        states
+    Methods:
+        -reachable: Returns the set of ids reachable from the given ids
+        -can_end: Returns the set of ids from which an End State can be
+        reached
+        -cycles: Returns the strongly connected components that form a cycle
+        -analyze: Returns the problems of the graph as a dictionary
+        -check: Raises InitializationError if the graph has errors
+        -to_dot, to_json: Export the graph
+    '''
+    def __init__(self, sm):
+        self.names = [s.name for s in sm.states.values()]
+        self.ids = dict((k, i) for i, k in enumerate(sm.states))
+        self.start = self.ids.get(sm.startState)
+        self.ends = set(self.ids[k] for k in sm.endStates)
+        self.unknown = []
+        self.errorEdges = set()
+        edges = []
+        for i, state in enumerate(sm.states.values()):
+            targets = []
+            for t in state.transitions:
+                j = self.ids.get(t.name.upper())
+                if j is None:
+                    self.unknown.append((state.name, t.name))
+                    continue
+                if j not in targets:
+                    targets.append(j)
+                if t.error:
+                    self.errorEdges.add((i, j))
+            edges.append(tuple(targets))
+        self.edges = tuple(edges)
+
+    def reachable(self, ids):
+        seen = set(ids)
+        pending = list(ids)
+        while pending:
+            for j in self.edges[pending.pop()]:
+                if j not in seen:
+                    seen.add(j)
+                    pending.append(j)
+        return seen
+
+    def can_end(self):
+        reverse = [[] for n in self.names]
+        for i, targets in enumerate(self.edges):
+            for j in targets:
+                reverse[j].append(i)
+        seen = set(self.ends)
+        pending = list(self.ends)
+        while pending:
+            for i in reverse[pending.pop()]:
+                if i not in seen:
+                    seen.add(i)
+                    pending.append(i)
+        return seen
+
+    def cycles(self):
+        # Tarjan's strongly connected components, without recursion
+        index = {}
+        low = {}
+        stack = []
+        onStack = set()
+        counter = 0
+        components = []
+        for root in range(len(self.names)):
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                i, k = work.pop()
+                if k == 0:
+                    index[i] = low[i] = counter
+                    counter += 1
+                    stack.append(i)
+                    onStack.add(i)
+                targets = self.edges[i]
+                if k < len(targets):
+                    work.append((i, k + 1))
+                    j = targets[k]
+                    if j not in index:
+                        work.append((j, 0))
+                    elif j in onStack:
+                        low[i] = min(low[i], index[j])
+                    continue
+                if low[i] == index[i]:
+                    component = []
+                    while True:
+                        j = stack.pop()
+                        onStack.discard(j)
+                        component.append(j)
+                        if j == i:
+                            break
+                    if len(component) > 1 or i in self.edges[i]:
+                        components.append(sorted(component))
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[i])
+        return components
+
+    def analyze(self):
+        names = self.names
+        reached = set()
+        if self.start is not None:
+            reached = self.reachable([self.start])
+        ending = self.can_end()
+        return collections.OrderedDict([
+            ('unknown', ['{0} -> {1}'.format(s, t) for s, t in self.unknown]),
+            ('deadEnds', [names[i] for i in range(len(names))
+                          if not(self.edges[i]) and i not in self.ends]),
+            ('trapped', [names[i] for i in sorted(reached - ending)]),
+            ('unreachable', [names[i] for i in range(len(names))
+                             if i not in reached]),
+            ('cycles', [[names[i] for i in c] for c in self.cycles()])])
+
+    def check(self):
+        report = self.analyze()
+        errors = []
+        for key, text in (('unknown', 'Unknown target states'),
+                          ('deadEnds', 'States without transitions'),
+                          ('trapped', 'States that never reach an End State')):
+            if report[key]:
+                errors.append('{0}: {1}'.format(text, ', '.join(report[key])))
+        if errors:
+            raise InitializationError('; '.join(errors))
+        return report
+
+    def to_dot(self):
+        lines = ['digraph StateMachine {']
+        for i, n in enumerate(self.names):
+            attrs = []
+            if i == self.start:
+                attrs.append('style=bold')
+            if i in self.ends:
+                attrs.append('shape=doublecircle')
+            attrs = ' [{}]'.format(', '.join(attrs)) if attrs else ''
+            lines.append('    {0}{1};'.format(json.dumps(n), attrs))
+        for i, targets in enumerate(self.edges):
+            for j in targets:
+                style = ' [style=dashed]' if (i, j) in self.errorEdges else ''
+                lines.append('    {0} -> {1}{2};'.format(
+                    json.dumps(self.names[i]), json.dumps(self.names[j]),
+                    style))
+        lines.append('}')
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps({'states':self.names, 'start':self.start,
+                           'ends':sorted(self.ends),
+                           'edges':[list(e) for e in self.edges],
+                           'errorEdges':sorted(self.errorEdges)})
+
+if __name__ == '__main__':
+    import sys
+    import nzsfRecovery
+    from SMEventLog import EventLog
+    graph = StateGraph(nzsfRecovery.build_state_machine(log=EventLog([])))
+    if '--json' in sys.argv:
+        print(graph.to_json())
+    elif '--check' in sys.argv:
+        print(json.dumps(graph.analyze(), indent=2))
+    else:
+        print(graph.to_dot())
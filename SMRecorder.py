@@ -0,0 +1,333 @@
+#!/usr/bin/env python3.5
+'''
+Binary run history for the State Machine library.
+RunRecorder is an EventLog sink that stores every run in a columnar,
+append-only store, with three tables per run:
+    -states: t, state. Time each state was entered
+    -transitions: t, state, target, error, wait. Transitions taken, with the
+    time spent deciding them
+    -samples: t, input, value. Every monitor update of the input channels
+States and inputs are stored as indexes into the stateNames and inputNames
+lists of the run metadata. Times are wall clock seconds, or the time of the
+State Machine clock if the recorder is given the same clock.
+Rows are written into preallocated NumPy buffers on the log writer thread and
+flushed in bulk when a buffer fills up or the run ends, so the transition loop
+only pays for the event it already emits, and the monitor callbacks only for
+appending a tuple to a queue.
+Usage:
+    rec = RunRecorder(HDF5Store('nzsf.h5'))
+    sm = build_state_machine(log=EventLog([StdoutSink(), rec]))
+    recs = make_records()
+    rec.attach(recs)
+    sm.run(recs)
+numpy and h5py are imported when a recorder or store is created.
+'''
+
+import os
+import json
+import time
+import collections
+
+# Rows of each preallocated buffer
+BUFFER_ROWS = 4096
+# Maximum number of monitor updates waiting to be stored
+SAMPLE_QUEUE = 1 << 16
+
+TABLES = collections.OrderedDict([
+    ('states', (('t', 'f8'), ('state', 'i4'))),
+    ('transitions', (('t', 'f8'), ('state', 'i4'), ('target', 'i4'),
+                     ('error', 'u1'), ('wait', 'f8'))),
+    ('samples', (('t', 'f8'), ('input', 'i4'), ('value', 'f8')))])
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+class ColumnBuffer:
+    '''
+    Preallocated NumPy arrays, one per column of a table. append returns True
+    when the buffer is full and has to be flushed
+    '''
+    def __init__(self, columns, rows=BUFFER_ROWS):
+        import numpy as np
+        self.names = [c for c, dtype in columns]
+        self.arrays = [np.empty(rows, dtype) for c, dtype in columns]
+        self.rows = rows
+        self.n = 0
+
+    def append(self, values):
+        n = self.n
+        for a, v in zip(self.arrays, values):
+            a[n] = v
+        self.n = n + 1
+        return self.n == self.rows
+
+    def take(self):
+        '''
+        Returns {column: array} with the buffered rows and empties the buffer.
+        The arrays are views, valid until the next append
+        '''
+        n = self.n
+        self.n = 0
+        return dict((c, a[:n]) for c, a in zip(self.names, self.arrays))
+
+class HDF5Store:
+    '''
+    Stores each run as the group /runs/RUN_ID of an HDF5 file, with one
+    chunked, resizable and compressed dataset per column, and the metadata as
+    attributes of the group
+    '''
+    def __init__(self, path, compression='gzip'):
+        import h5py
+        self.file = h5py.File(path, 'a')
+        self.compression = compression
+
+    def open_run(self, runId):
+        group = self.file.require_group('runs').create_group(runId)
+        for table, columns in TABLES.items():
+            tg = group.create_group(table)
+            for c, dtype in columns:
+                tg.create_dataset(c, (0,), dtype=dtype, maxshape=(None,),
+                                  chunks=(BUFFER_ROWS,),
+                                  compression=self.compression)
+
+    def append(self, runId, table, columns):
+        tg = self.file['runs'][runId][table]
+        for c, values in columns.items():
+            ds = tg[c]
+            n = ds.shape[0]
+            ds.resize((n + len(values),))
+            ds[n:] = values
+
+    def close_run(self, runId, meta):
+        group = self.file['runs'][runId]
+        for k, v in meta.items():
+            group.attrs[k] = json.dumps(v)
+        self.file.flush()
+
+    def runs(self):
+        if 'runs' not in self.file:
+            return []
+        return list(self.file['runs'])
+
+    def load(self, runId):
+        group = self.file['runs'][runId]
+        run = {'meta':dict((k, json.loads(v))
+                           for k, v in group.attrs.items())}
+        for table in TABLES:
+            run[table] = dict((c, group[table][c][:]) for c in group[table])
+        return run
+
+    def close(self):
+        self.file.close()
+
+class MemmapStore:
+    '''
+    Stores each run as the directory PATH/RUN_ID, with one raw binary file
+    per column (TABLE.COLUMN.bin) that is appended to and read back as a
+    numpy.memmap, and the metadata in meta.json
+    '''
+    def __init__(self, path):
+        import numpy
+        self.np = numpy
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def column_path(self, runId, table, column):
+        return os.path.join(self.path, runId,
+                            '{0}.{1}.bin'.format(table, column))
+
+    def open_run(self, runId):
+        os.makedirs(os.path.join(self.path, runId))
+
+    def append(self, runId, table, columns):
+        for c, values in columns.items():
+            with open(self.column_path(runId, table, c), 'ab') as f:
+                values.tofile(f)
+
+    def close_run(self, runId, meta):
+        with open(os.path.join(self.path, runId, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def runs(self):
+        return sorted(d for d in os.listdir(self.path)
+                      if os.path.exists(os.path.join(self.path, d,
+                                                     'meta.json')))
+
+    def load(self, runId):
+        with open(os.path.join(self.path, runId, 'meta.json')) as f:
+            run = {'meta':json.load(f)}
+        for table, columns in TABLES.items():
+            run[table] = {}
+            for c, dtype in columns:
+                path = self.column_path(runId, table, c)
+                if os.path.exists(path) and os.path.getsize(path):
+                    values = self.np.memmap(path, dtype, mode='r')
+                else:
+                    values = self.np.empty(0, dtype)
+                run[table][c] = values
+        return run
+
+    def close(self):
+        pass
+
+def open_store(path):
+    '''
+    Returns a MemmapStore if path is a directory, an HDF5Store otherwise
+    '''
+    if os.path.isdir(path):
+        return MemmapStore(path)
+    return HDF5Store(path)
+
+class RecordedRun:
+    '''
+    Buffers and metadata of one run being recorded
+    '''
+    def __init__(self, runId, meta, rows):
+        self.runId = runId
+        self.meta = meta
+        self.buffers = collections.OrderedDict(
+            (table, ColumnBuffer(columns, rows))
+            for table, columns in TABLES.items())
+        self.stateNames = []
+        self.stateIds = {}
+
+    def state_id(self, name):
+        sid = self.stateIds.get(name)
+        if sid is None:
+            sid = self.stateIds[name] = len(self.stateNames)
+            self.stateNames.append(name)
+        return sid
+
+    def add_row(self, store, table, values):
+        if self.buffers[table].append(values):
+            store.append(self.runId, table, self.buffers[table].take())
+
+class RunRecorder:
+    '''
+    EventLog sink that records every run into a store. Runs that overlap,
+    e.g. under a Supervisor or a Daemon sharing one log, are recorded
+    separately, and each of them gets every input sample taken while it runs.
+    Atributes:
+        -store: HDF5Store or MemmapStore
+        -clock: Clock of the recorded State Machine. If None the wall clock
+        is used
+        -inputNames: Names of the sampled inputs, set by attach
+        -runs: Dictionary of {runId: RecordedRun} of the runs being recorded
+    Methods:
+        -attach: Subscribes to the monitor updates of the input channels of
+        records. Inputs that aren't channels (e.g. prevState) are skipped
+        -detach: Removes the monitor subscriptions
+        -write, flush, close: EventLog sink interface
+    '''
+    def __init__(self, store, rows=BUFFER_ROWS, clock=None):
+        self.store = store
+        self.clock = clock
+        self.rows = rows
+        self.inputNames = []
+        self.monitors = []
+        # Latest value of each input, written as the first samples of a run
+        self.last = []
+        # Filled by the monitor callbacks, emptied by the writer thread
+        self.pending = collections.deque(maxlen=SAMPLE_QUEUE)
+        self.runs = collections.OrderedDict()
+
+    def attach(self, records):
+        for n, pv in records['Input'].items():
+            if not(hasattr(pv, 'add_callback')):
+                continue
+            idx = len(self.inputNames)
+            self.inputNames.append(n)
+            self.last.append(to_float(pv.value))
+            self.monitors.append((pv, pv.add_callback(self.monitor(idx))))
+
+    def monitor(self, idx):
+        now = time.time if self.clock is None else self.clock.now
+        pending = self.pending
+
+        def callback(value=None, **kw):
+            pending.append((now(), idx, value))
+        return callback
+
+    def event_time(self, record):
+        if self.clock is None:
+            return record['time']
+        return record['clock']
+
+    def detach(self):
+        for pv, index in self.monitors:
+            pv.remove_callback(index)
+        self.monitors = []
+
+    def take_samples(self, until=float('inf')):
+        # Events reach the writer later than the monitor updates, so the
+        # samples are assigned to runs by their time
+        pending = self.pending
+        last = self.last
+        runs = self.runs.values()
+        while pending and pending[0][0] <= until:
+            t, idx, value = pending.popleft()
+            value = last[idx] = to_float(value)
+            for run in runs:
+                run.add_row(self.store, 'samples', (t, idx, value))
+
+    def write(self, record):
+        event = record['event']
+        if 'run' not in record:
+            return
+        self.take_samples(self.event_time(record))
+        if event == 'run_start' and record['run'] not in self.runs:
+            self.start_run(record)
+        run = self.runs.get(record['run'])
+        if run is None:
+            return
+        if event in ('run_start', 'state_enter', 'run_end'):
+            run.add_row(self.store, 'states',
+                        (self.event_time(record),
+                         run.state_id(record['state'])))
+        elif event == 'transition':
+            run.add_row(self.store, 'transitions',
+                        (self.event_time(record),
+                         run.state_id(record['state']),
+                         run.state_id(record['target']), record['error'],
+                         record['wait']))
+        if event == 'run_end':
+            self.end_run(run, record)
+
+    def start_run(self, record):
+        runId = record['run']
+        start = self.event_time(record)
+        self.store.open_run(runId)
+        run = self.runs[runId] = RecordedRun(
+            runId, {'run':runId, 'start':start,
+                    'timeout':record.get('timeout')}, self.rows)
+        # Values of the inputs when the run starts
+        for idx, value in enumerate(self.last):
+            run.add_row(self.store, 'samples', (start, idx, value))
+
+    def end_run(self, run, record):
+        for table, b in run.buffers.items():
+            if b.n:
+                self.store.append(run.runId, table, b.take())
+        run.meta['stateNames'] = run.stateNames
+        run.meta['inputNames'] = self.inputNames
+        if record is not None:
+            run.meta['end'] = self.event_time(record)
+            run.meta['endState'] = record['state']
+        self.store.close_run(run.runId, run.meta)
+        del self.runs[run.runId]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.detach()
+        self.take_samples()
+        for run in list(self.runs.values()):
+            self.end_run(run, None)
+        self.store.close()
+
+if __name__ == '__main__':
+    pass
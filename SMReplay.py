@@ -0,0 +1,169 @@
+#!/usr/bin/env python3.5
+'''
+Offline replay of recorded runs (see SMRecorder) through a State Machine.
+The recorded input samples are posted to simulated channels on a
+VirtualClock, so a run that took minutes on the telescope replays in
+milliseconds, and the transition tables decide exactly as they would have on
+the recorded inputs. Handlers are not run: the inputs already contain the
+reaction of the hardware.
+Usage:
+    python3 SMReplay.py STORE [RUN_ID ...]
+replays the recorded runs of STORE (HDF5 file or memmap directory) through
+the tables of nzsfRecovery.py and reports the runs whose state path differs
+from the recorded one. From a script:
+    replayer = Replayer(nzsfRecovery.build_state_machine,
+                        nzsfRecovery.make_records)
+    for result in replayer.replay_store(open_store('nzsf.h5')):
+        print(result['runId'], result['path'])
+'''
+
+import collections
+
+from StateMachineLib import VirtualClock
+from SMEventLog import EventLog
+from SMSim import SimBackend
+
+def change_points(samples):
+    '''
+    Returns the indexes, in recording order, of the samples that change the
+    value of their input. Repeated values are dropped with a vectorized scan
+    over the samples sorted by input and time.
+    '''
+    import numpy as np
+    t = np.asarray(samples['t'])
+    inp = np.asarray(samples['input'])
+    value = np.asarray(samples['value'])
+    if not(len(t)):
+        return np.empty(0, int)
+    order = np.lexsort((t, inp))
+    inp = inp[order]
+    value = value[order]
+    same = (value[1:] == value[:-1]) | (np.isnan(value[1:])
+                                        & np.isnan(value[:-1]))
+    keep = np.ones(len(order), bool)
+    keep[1:] = (inp[1:] != inp[:-1]) | ~same
+    return np.sort(order[keep])
+
+class TraceSink:
+    '''
+    EventLog sink that keeps the engine events of the replayed run
+    '''
+    EVENTS = ('run_start', 'state_enter', 'transition', 'run_end')
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        if record['event'] in self.EVENTS:
+            self.records.append(record)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class Replayer:
+    '''
+    Replays recorded runs through a State Machine.
+    Atributes:
+        -sm: StateMachine with the transition tables to test, built by the
+        given function, as nzsfRecovery.build_state_machine, with the
+        replay log. It is private to the Replayer, so replays never change
+        the clock, log or handlers of a machine that is in service, and it
+        is reused for every run, each with its own VirtualClock
+        -make_records: Function that builds the records from a pool, as
+        nzsfRecovery.make_records
+    Methods:
+        -replay: Replays a run loaded from a store and returns a dictionary
+        with the runId, the endState, the state path and the decisions
+        [(time, state, target, error)] of the replay, the recorded path and
+        whether both paths match. Times are seconds from the start of the run
+        -replay_store: Replays the given runs of a store, or all of them,
+        yielding the result of each one
+    '''
+    def __init__(self, build, make_records):
+        self.make_records = make_records
+        self.trace = TraceSink()
+        self.log = EventLog([self.trace])
+        self.sm = build(log=self.log)
+        self.sm.runHandlers = False
+
+    def schedule(self, run, recs, clock):
+        samples = run['samples']
+        names = run['meta']['inputNames']
+        start = run['meta']['start']
+        inpt = recs['Input']
+        t = samples['t']
+        inp = samples['input']
+        value = samples['value']
+        for i in change_points(samples):
+            n = names[inp[i]]
+            if n not in inpt:
+                continue
+            # Filtered inputs are fed through their simulated channel
+            pv = getattr(inpt[n], 'pv', inpt[n])
+            if t[i] <= start:
+                # Values when the run started
+                pv.post(float(value[i]))
+            else:
+                clock.call_at(float(t[i] - start), pv.post, float(value[i]))
+
+    def replay(self, run, timeout=None):
+        clock = VirtualClock()
+        sim = SimBackend(clock=clock)
+        recs = self.make_records(sim, clock)
+        sm = self.sm
+        sm.clock = clock
+        sm.validate(recs)
+        self.schedule(run, recs, clock)
+        del self.trace.records[:]
+        endState = sm.run_sequence(recs, timeout)
+        path = []
+        decisions = []
+        for r in self.trace.records:
+            if r['event'] == 'transition':
+                decisions.append((r['clock'], r['state'], r['target'],
+                                  r['error']))
+            else:
+                path.append(r['state'])
+        stateNames = run['meta']['stateNames']
+        recorded = [stateNames[s] for s in run['states']['state']]
+        return collections.OrderedDict([
+            ('runId', run['meta']['run']),
+            ('endState', endState),
+            ('path', path),
+            ('decisions', decisions),
+            ('recordedPath', recorded),
+            ('matches', path == recorded)])
+
+    def replay_store(self, store, runs=None, timeout=None):
+        if runs is None:
+            runs = store.runs()
+        for runId in runs:
+            yield self.replay(store.load(runId), timeout)
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import nzsfRecovery
+    from SMRecorder import open_store
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    store = open_store(sys.argv[1])
+    replayer = Replayer(nzsfRecovery.build_state_machine,
+                        nzsfRecovery.make_records)
+    startTime = time.perf_counter()
+    total = 0
+    changed = 0
+    for result in replayer.replay_store(store, sys.argv[2:] or None):
+        total += 1
+        if not(result['matches']):
+            changed += 1
+            print('{0}: recorded {1}, replayed {2}'.format(
+                result['runId'], ' > '.join(result['recordedPath']),
+                ' > '.join(result['path'])))
+    print('{0} runs replayed in {1:.2f} s, {2} changed'.format(
+        total, time.perf_counter() - startTime, changed))
+    sys.exit(1 if changed else 0)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3.5
+'''
+In-process simulated channels, to run State Machines without an IOC.
+SimBackend has the same get/make_records interface as PVPool, so any script
+that builds its records from a pool can run against simulated channels:
+    sim = SimBackend()
+    recs = nzsfRecovery.make_records(pool=sim)
+    sim.timeline('mc:FollowL', [(0.5, 1), (2.0, 0)])
+    sim.start()
+With a VirtualClock the timelines are scheduled on the clock instead of a
+thread, and the whole run happens in simulated time:
+    clock = VirtualClock()
+    sim = SimBackend(clock=clock)
+    sm = nzsfRecovery.build_state_machine(clock=clock)
+'''
+
+import time
+import heapq
+import threading
+import itertools
+import collections
+
+from StateMachineLib import make_input
+
+class SimPV:
+    '''
+    Simulated channel with the subset of the epics.PV interface used by the
+    State Machine library.
+    Atributes:
+        -pvname: Channel name
+        -value: Current value
+        -connected: Connection state, wait_for_connection fails if False
+        -latency: Time a put takes to complete and to update the value
+        -on_put: Optional function called as on_put(pv, value) after a put
+        completes, used to script how the simulated hardware reacts
+    Methods:
+        -post: Sets a new value and runs the monitor callbacks, as a monitor
+        update from the IOC would
+        -put: Writes a value, waiting latency seconds if wait is True
+        -add_callback, remove_callback, wait_for_connection: Same as epics.PV
+    '''
+    def __init__(self, pvname, value=0, backend=None, latency=0.0):
+        self.pvname = pvname
+        self.value = value
+        self.backend = backend
+        self.latency = latency
+        self.connected = True
+        self.on_put = None
+        self.callbacks = {}
+        self.index = itertools.count(1)
+        self.lock = threading.Lock()
+        self.puts = []
+
+    def __repr__(self):
+        return 'SimPV({0!r}, value={1!r})'.format(self.pvname, self.value)
+
+    def add_callback(self, callback=None, index=None, run_now=False, **kw):
+        with self.lock:
+            if index is None:
+                index = next(self.index)
+            self.callbacks[index] = callback
+        if run_now:
+            callback(pvname=self.pvname, value=self.value)
+        return index
+
+    def remove_callback(self, index=None):
+        with self.lock:
+            self.callbacks.pop(index, None)
+
+    def wait_for_connection(self, timeout=None):
+        return self.connected
+
+    def post(self, value):
+        self.value = value
+        with self.lock:
+            callbacks = list(self.callbacks.values())
+        for cb in callbacks:
+            cb(pvname=self.pvname, value=value)
+
+    def put(self, value, wait=False, timeout=30.0, **kw):
+        self.puts.append(value)
+        if self.latency and self.backend is not None and not(wait):
+            self.backend.call_later(self.latency, self.complete_put, value)
+            return 1
+        if self.latency and self.backend is not None:
+            self.backend.sleep(self.latency)
+        self.complete_put(value)
+        return 1
+
+    def complete_put(self, value):
+        self.post(value)
+        if self.on_put is not None:
+            self.on_put(self, value)
+
+class SimBackend:
+    '''
+    Pool of SimPV objects plus a scheduler that plays scripted value
+    timelines and periodic updates. The scheduler is a thread running on real
+    time, or the clock itself if clock is a VirtualClock.
+    Methods:
+        -get: Returns the SimPV for pvname, creating it on first use
+        -make_records: Same as PVPool.make_records
+        -call_later: Runs fn(*args) on the scheduler thread after delay
+        seconds
+        -timeline: Schedules [(time, value), ...] updates of a channel,
+        times are relative to start()
+        -periodic: Posts fn(t) to a channel rate times per second from
+        start() until stop()
+        -start, stop: Start and stop the scheduler thread
+    '''
+    def __init__(self, latency=0.0, defaults=None, clock=None):
+        self.latency = latency
+        self.clock = clock
+        self.virtual = clock is not None and clock.virtual
+        self.defaults = defaults or {}
+        self.pvs = collections.OrderedDict()
+        self.events = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.startTime = None
+        self.pending = []
+
+    def now(self):
+        if self.clock is not None:
+            return self.clock.now()
+        return time.monotonic()
+
+    def sleep(self, delay):
+        if self.clock is not None:
+            self.clock.sleep(delay)
+        else:
+            time.sleep(delay)
+
+    def get(self, pvname):
+        pv = self.pvs.get(pvname)
+        if pv is None:
+            pv = SimPV(pvname, self.defaults.get(pvname, 0), self,
+                       self.latency)
+            self.pvs[pvname] = pv
+        return pv
+
+    def make_records(self, inputPVs, outputPVs):
+        inputs = collections.OrderedDict()
+        outputs = collections.OrderedDict()
+        for n in inputPVs:
+            inputs[n] = make_input(self, inputPVs[n], self.clock)
+        for n in outputPVs:
+            outputs[n] = self.get(outputPVs[n])
+        return {'Input':inputs, 'Output':outputs}
+
+    def call_at(self, when, fn, *args):
+        if self.virtual:
+            self.clock.call_at(when, fn, *args)
+            return
+        with self.cond:
+            heapq.heappush(self.events, (when, next(self.seq), fn, args))
+            self.cond.notify()
+
+    def call_later(self, delay, fn, *args):
+        self.call_at(self.now() + delay, fn, *args)
+
+    def timeline(self, pvname, points):
+        pv = self.get(pvname)
+        if self.startTime is None:
+            # Played relative to start()
+            self.pending.append((pvname, points))
+            return
+        for t, value in points:
+            self.call_at(self.startTime + t, pv.post, value)
+
+    def periodic(self, pvname, rate, fn):
+        pv = self.get(pvname)
+        period = 1.0/rate
+
+        def update(tick):
+            if not(self.running):
+                return
+            pv.post(fn(tick*period))
+            self.call_at(self.startTime + (tick + 1)*period, update, tick + 1)
+
+        if self.startTime is None:
+            self.pending.append((pvname, lambda: update(0)))
+        else:
+            update(int((self.now() - self.startTime)*rate))
+
+    def start(self):
+        self.startTime = self.now()
+        self.running = True
+        pending, self.pending = self.pending, []
+        for pvname, points in pending:
+            if callable(points):
+                points()
+            else:
+                self.timeline(pvname, points)
+        if not(self.virtual):
+            self.thread = threading.Thread(target=self.run_events,
+                                           daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run_events(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    if self.events:
+                        delay = self.events[0][0] - self.now()
+                        if delay <= 0:
+                            break
+                        self.cond.wait(delay)
+                    else:
+                        self.cond.wait()
+                if not(self.running):
+                    return
+                when, seq, fn, args = heapq.heappop(self.events)
+            fn(*args)
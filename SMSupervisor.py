@@ -0,0 +1,105 @@
+#!/usr/bin/env python3.5
+
+import sys
+import threading
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+from StateMachineLib import PVPool, InitializationError, CONNECT_TIME
+
+class Supervisor:
+    '''
+    This class runs many independent StateMachine objects concurrently in a
+    single process, on a pool of worker threads.
+    All the workers share the process Channel Access context, and the records
+    of every machine should be built from the supervisor PVPool so that each
+    PV name is connected only once.
+    A machine holds its worker for the whole run, so there is one worker per
+    machine: a machine queued behind the others would only start after they
+    end, with its deadlines already spent.
+    Atributes:
+        -workers: Maximum number of machines. If None the pool is sized to
+        the machines registered when the first one starts
+        -pool: PVPool shared by all the machines
+        -connTimeout: Maximum time each machine waits for its channels to
+        connect before it is declared failed
+        -machines: Dictionary of {name: (StateMachine, records, timeout)}
+        -results: Dictionary of {name: end state name or exception} for the
+        machines that already finished
+    Methods:
+        -add_machine: Registers a StateMachine with its own records and
+        timeout. The machine is validated here, so initialization errors are
+        raised to the caller instead of ending the worker. Raises
+        InitializationError if there is no worker left for it
+        -start: Starts one machine and returns its Future
+        -run_all: Starts every machine (or the given ones), waits for them and
+        returns the results dictionary
+        -shutdown: Waits for the running machines and stops the workers
+    '''
+    def __init__(self, workers=None, pool=None, connTimeout=CONNECT_TIME):
+        if pool is None:
+            pool = PVPool()
+        self.pool = pool
+        self.connTimeout = connTimeout
+        self.machines = collections.OrderedDict()
+        self.results = {}
+        self.running = {}
+        self.lock = threading.Lock()
+        self.workers = workers
+        # Created by the first start, once the number of machines is known
+        self.executor = None
+
+    def add_machine(self, name, sm, records, timeout=None):
+        if name not in self.machines and self.workers is not None and \
+                len(self.machines) >= self.workers:
+            raise InitializationError(
+                'No worker left for machine {0}, the supervisor has {1}'.format(
+                    name, self.workers))
+        sm.validate(records)
+        self.machines[name] = (sm, records, timeout)
+
+    def start(self, name):
+        sm, records, timeout = self.machines[name]
+        with self.lock:
+            if name in self.running:
+                raise RuntimeError('Machine {} is already running'.format(name))
+            if self.executor is None:
+                if self.workers is None:
+                    self.workers = len(self.machines)
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            future = self.executor.submit(self.run_machine, name, sm,
+                                          records, timeout)
+            self.running[name] = future
+        return future
+
+    def run_machine(self, name, sm, records, timeout):
+        # Worker threads must attach to the shared context before using CA
+        epics = sys.modules.get('epics')
+        if epics is not None:
+            epics.ca.use_initial_context()
+        try:
+            sm.connect(records, self.connTimeout)
+            result = sm.run_sequence(records, timeout)
+        except Exception as err:
+            sm.log.emit('error', 'Machine {0} failed: {1!r}'.format(name, err),
+                        machine=name)
+            result = err
+        with self.lock:
+            self.results[name] = result
+            del self.running[name]
+        return result
+
+    def run_all(self, names=None):
+        if names is None:
+            names = list(self.machines)
+        futures = [self.start(n) for n in names]
+        for f in futures:
+            f.result()
+        return dict((n, self.results[n]) for n in names)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+if __name__ == '__main__':
+    pass
@@ -1,28 +1,941 @@
 #!/usr/bin/env python3.5
 
-import os
-import argparse
-import epics
+import sys
 import time
-import h5py
-import re
-import numpy as np
+import json
+import queue
+import heapq
+import bisect
+import itertools
 import collections
+import threading
+import functools
 
-from datetime import datetime, timedelta
+from SMEventLog import EventLog
+
+# epics, asyncio and inspect are imported where they are used, so that
+# scripts that only need the synchronous engine start faster
 
 ERROR_TIME = 1.5*60
+# Re-evaluation period used when there are no monitorable inputs
+POLL_TIME = 0.05
+# Maximum time to wait for the values of a batched snapshot read
+SNAPSHOT_TIMEOUT = 1.0
+# Maximum time to wait for all the channels to connect before starting
+CONNECT_TIME = 5.0
+# Maximum time to wait for the completion callback of an output put
+PUT_TIMEOUT = 5.0
+
+class MonotonicClock:
+    '''
+    Real time source. Uses the monotonic clock, so waits and deadlines are not
+    affected by steps of the system wall clock.
+    Methods:
+        -now: Current time in seconds
+        -sleep: Blocks for delay seconds
+        -wait: Waits on a threading.Event for up to timeout seconds, returns
+        True if the event was set
+    '''
+    virtual = False
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep(self, delay):
+        time.sleep(delay)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)
+
+class VirtualClock:
+    '''
+    Simulated time source for running State Machines faster than real time.
+    Time only moves when someone sleeps or waits on the clock: it jumps
+    straight to the next scheduled callback, or to the end of the wait if
+    nothing is scheduled before it, running the scheduled callbacks on the
+    way. Everything driven by a VirtualClock runs on the calling thread, so
+    runs are deterministic.
+    Methods:
+        -now, sleep, wait: Same as MonotonicClock, in simulated time
+        -call_at, call_later: Schedule fn(*args) at an absolute time or
+        after a delay
+        -advance: Moves time forward by delay seconds
+        -next_event: Time of the next scheduled callback, or default if
+        there is none
+    '''
+    virtual = True
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self.events = []
+        self.seq = itertools.count()
+
+    def now(self):
+        return self.time
+
+    def call_at(self, when, fn, *args):
+        heapq.heappush(self.events, (when, next(self.seq), fn, args))
+
+    def call_later(self, delay, fn, *args):
+        self.call_at(self.time + delay, fn, *args)
+
+    def run_until(self, when, event=None):
+        while not(event is not None and event.is_set()):
+            if not(self.events) or self.events[0][0] > when:
+                self.time = max(self.time, when)
+                break
+            t, seq, fn, args = heapq.heappop(self.events)
+            self.time = max(self.time, t)
+            fn(*args)
+        return event is not None and event.is_set()
+
+    def next_event(self, default=None):
+        return self.events[0][0] if self.events else default
+
+    def sleep(self, delay):
+        self.run_until(self.time + delay)
+
+    def advance(self, delay):
+        self.run_until(self.time + delay)
+
+    def wait(self, event, timeout):
+        return self.run_until(self.time + timeout, event)
+
+DEFAULT_CLOCK = MonotonicClock()
+
+# Event log used by the States and State Machines that are not given one,
+# it writes the messages of the State Machine to stdout
+DEFAULT_LOG = EventLog()
+
+class MonitorWait:
+    '''
+    Wait strategy that re-evaluates the predicate only when one of the inputs
+    posts a monitor update. Inputs that do not support monitors (anything
+    without add_callback) are ignored; if none of the inputs can be monitored
+    the predicate is polled every pollPeriod seconds.
+    '''
+    def __init__(self, pollPeriod=POLL_TIME):
+        self.pollPeriod = pollPeriod
+
+    def wait(self, predicate, inputs, timeout, clock=DEFAULT_CLOCK):
+        changed = threading.Event()
+        monitors = []
+        for pv in inputs:
+            if hasattr(pv, 'add_callback'):
+                idx = pv.add_callback(lambda **kw: changed.set(),
+                                      with_ctrlvars=False)
+                monitors.append((pv, idx))
+        deadline = clock.now() + timeout
+        try:
+            while True:
+                # Clear before evaluating, so an update that arrives during
+                # the evaluation wakes up the next wait
+                changed.clear()
+                if predicate():
+                    return True
+                remaining = deadline - clock.now()
+                if remaining <= 0:
+                    return False
+                if not(monitors):
+                    remaining = min(remaining, self.pollPeriod)
+                clock.wait(changed, remaining)
+        finally:
+            for pv, idx in monitors:
+                pv.remove_callback(idx)
+
+class BackoffWait:
+    '''
+    Wait strategy that polls the predicate, starting every minPeriod seconds
+    and multiplying the period by factor after each miss up to maxPeriod.
+    A period of 0 polls continuously; on a virtual clock, where polling
+    without sleeping never moves time, it polls again on the next scheduled
+    event instead.
+    '''
+    def __init__(self, minPeriod=0.001, maxPeriod=0.1, factor=2.0):
+        self.minPeriod = minPeriod
+        self.maxPeriod = maxPeriod
+        self.factor = factor
+
+    def wait(self, predicate, inputs, timeout, clock=DEFAULT_CLOCK):
+        period = self.minPeriod
+        deadline = clock.now() + timeout
+        while True:
+            if predicate():
+                return True
+            remaining = deadline - clock.now()
+            if remaining <= 0:
+                return False
+            delay = min(period, remaining)
+            if delay <= 0 and clock.virtual:
+                delay = min(clock.next_event(deadline), deadline) - clock.now()
+            clock.sleep(delay)
+            period = min(period*self.factor, self.maxPeriod)
+
+class FixedRateWait:
+    '''
+    Wait strategy that polls the predicate at a fixed rate of one evaluation
+    every period seconds, independently of how long each evaluation takes.
+    '''
+    def __init__(self, period=POLL_TIME):
+        self.period = period
+
+    def wait(self, predicate, inputs, timeout, clock=DEFAULT_CLOCK):
+        startTime = clock.now()
+        deadline = startTime + timeout
+        tick = 0
+        while True:
+            if predicate():
+                return True
+            now = clock.now()
+            if now >= deadline:
+                return False
+            tick += 1
+            nextTime = startTime + tick*self.period
+            if nextTime < now:
+                # Evaluation overran the period, skip the missed ticks
+                tick = int((now - startTime)/self.period) + 1
+                nextTime = startTime + tick*self.period
+            clock.sleep(min(nextTime, deadline) - now)
+
+DEFAULT_WAIT = MonitorWait()
+# Evaluates the conditions continuously, as States did before they waited on
+# monitors. Used by States created with eventDriven=False
+CONTINUOUS_WAIT = BackoffWait(0.0, 0.0)
+
+class Sample:
+    '''
+    Value of an input frozen when a snapshot was taken. It exposes the same
+    value attribute as epics.PV, so conditions written for PVs work
+    unchanged on a snapshot.
+    '''
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return 'Sample({!r})'.format(self.value)
+
+def take_snapshot(names, inpt):
+    '''
+    Reads every input in names once and returns a {name: value} dictionary
+    where PVs are replaced by Sample objects.
+    Monitored PVs give their latest monitor value without any network
+    traffic. PVs without monitor are requested together and collected after
+    a single flush. Inputs that are not PVs (e.g. prevState) are copied as
+    they are, and names not present in inpt are skipped.
+    '''
+    snap = {}
+    pending = []
+    for n in names:
+        if n not in inpt:
+            continue
+        pv = inpt[n]
+        if not(hasattr(pv, 'value')):
+            snap[n] = pv
+        elif hasattr(pv, 'chid') and not(pv.auto_monitor) and pv.connected:
+            pending.append((n, pv))
+        else:
+            snap[n] = Sample(pv.value)
+    if pending:
+        import epics
+        for n, pv in pending:
+            epics.ca.get(pv.chid, wait=False)
+        epics.ca.poll()
+        for n, pv in pending:
+            snap[n] = Sample(epics.ca.get_complete(pv.chid,
+                                                   timeout=SNAPSHOT_TIMEOUT))
+    return snap
+
+async def resolve(result):
+    '''
+    Returns result, awaiting it first if it is a coroutine or a future.
+    Lets handlers and conditions be either plain functions or coroutines.
+    '''
+    import inspect
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+def wait_until(predicate, inputs, timeout, strategy=None, clock=None):
+    '''
+    Blocks until predicate() returns True or timeout seconds have passed.
+    The predicate is evaluated once more when the timeout expires.
+        -predicate: function without arguments
+        -inputs: list of inputs the predicate reads, used by strategies that
+        wait on monitor updates
+        -timeout: maximum wait time in seconds
+        -strategy: MonitorWait, BackoffWait or FixedRateWait object. If None
+        DEFAULT_WAIT is used
+        -clock: MonotonicClock or VirtualClock used to measure the timeout.
+        If None DEFAULT_CLOCK is used
+    Returns True if the predicate was met, False if the wait timed out.
+    '''
+    if strategy is None:
+        strategy = DEFAULT_WAIT
+    if clock is None:
+        clock = DEFAULT_CLOCK
+    return strategy.wait(predicate, inputs, timeout, clock)
+
+async def async_wait_until(predicate, inputs, timeout, pollPeriod=POLL_TIME):
+    '''
+    Coroutine version of wait_until. Waits on monitor updates of the inputs
+    without blocking the event loop; the monitor callbacks, which run on the
+    Channel Access threads, are handed over to the loop thread-safely.
+    predicate can be a plain function or a coroutine function.
+    '''
+    import asyncio
+    loop = asyncio.get_event_loop()
+    changed = asyncio.Event()
+    monitors = []
+    for pv in inputs:
+        if hasattr(pv, 'add_callback'):
+            idx = pv.add_callback(
+                lambda **kw: loop.call_soon_threadsafe(changed.set),
+                with_ctrlvars=False)
+            monitors.append((pv, idx))
+    deadline = loop.time() + timeout
+    try:
+        while True:
+            changed.clear()
+            if await resolve(predicate()):
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            if not(monitors):
+                remaining = min(remaining, pollPeriod)
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for pv, idx in monitors:
+            pv.remove_callback(idx)
 
 class InitializationError(Exception):
     def __init__(self, message):
-        super().__init__()
+        super().__init__(message)
         self.message = 'InitializationError: ' + message
 
+class TransitionError(Exception):
+    '''
+    Raised when a State gives up waiting, because all its deadlines expired,
+    and none of its transitions is met
+    '''
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = 'TransitionError: ' + message
+
+def connect_channels(records, timeout=CONNECT_TIME):
+    '''
+    Waits until every input and output channel in records is connected, or
+    until timeout seconds have passed. Channels start connecting as soon as
+    they are created, so all of them connect concurrently and the wait only
+    lasts as long as the slowest one. Values that are not channels (e.g.
+    prevState) are skipped.
+    Returns a list with the names of the channels that did not connect.
+    '''
+    deadline = time.monotonic() + timeout
+    failed = []
+    for io in ('Input', 'Output'):
+        chans = records.get(io, {})
+        for n in chans:
+            pv = chans[n]
+            if not(hasattr(pv, 'wait_for_connection')):
+                continue
+            remaining = max(0, deadline - time.monotonic())
+            if not(pv.wait_for_connection(timeout=remaining)):
+                failed.append('{0} ({1})'.format(
+                    n, getattr(pv, 'pvname', '')))
+    return failed
+
+class InputFilter:
+    '''
+    Declaration of an input channel whose updates are filtered before they
+    reach the transitions, used in place of the pvname in the inputs
+    dictionary given to make_records:
+        inputPVs['voltAz'] = InputFilter('gis:mon:azmon3:azdspdspc.VAL',
+                                         deadband=0.01, minInterval=0.1)
+    Atributes:
+        -pvname: Channel name
+        -deadband: Minimum change of the value that is passed on
+        -minInterval: Minimum time in seconds between two updates passed on.
+        The last value held back is passed on when the interval ends
+        -smoothing: Weight of a new sample in an exponential moving average
+        of the value, between 0 and 1. If None the value is not smoothed
+        -serverDeadband: If True the deadband is also requested from the IOC
+        with a dbnd channel filter, so smaller changes are not even sent.
+        Needs an IOC with server side filters (EPICS 3.15 or later)
+    '''
+    def __init__(self, pvname, deadband=0.0, minInterval=0.0, smoothing=None,
+                 serverDeadband=False):
+        self.pvname = pvname
+        self.deadband = deadband
+        self.minInterval = minInterval
+        self.smoothing = smoothing
+        self.serverDeadband = serverDeadband
+
+    def channel_name(self):
+        if not(self.serverDeadband and self.deadband):
+            return self.pvname
+        dbnd = '{{"dbnd":{{"abs":{0!r}}}}}'.format(self.deadband)
+        if '.' in self.pvname:
+            return self.pvname + dbnd
+        return self.pvname + '.' + dbnd
+
+class FilteredInput:
+    '''
+    Input channel that applies the smoothing, deadband and minimum update
+    interval of an InputFilter to the monitor updates of a PV. It has the
+    value, add_callback, remove_callback and wait_for_connection interface of
+    epics.PV, so the transitions and the wait strategies only see (and are
+    only woken up by) the filtered updates.
+    '''
+    def __init__(self, pv, spec, clock=None):
+        self.pv = pv
+        self.pvname = pv.pvname
+        self.spec = spec
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        self.clock = clock
+        self.callbacks = {}
+        self.index = itertools.count(1)
+        self.lock = threading.Lock()
+        self.filtered = None
+        self.average = None
+        self.last = None
+        self.held = False
+        self.subscribed = False
+
+    @property
+    def value(self):
+        if not(self.subscribed):
+            self.subscribe()
+        return self.filtered
+
+    @property
+    def connected(self):
+        return self.pv.connected
+
+    def wait_for_connection(self, timeout=None):
+        ok = self.pv.wait_for_connection(timeout=timeout)
+        if ok:
+            self.subscribe()
+        return ok
+
+    def subscribe(self):
+        with self.lock:
+            if self.subscribed:
+                return
+            self.subscribed = True
+            self.filtered = self.average = self.pv.value
+            self.last = self.clock.now()
+        self.pv.add_callback(self.update)
+
+    def add_callback(self, callback=None, **kw):
+        self.subscribe()
+        with self.lock:
+            index = next(self.index)
+            self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index=None):
+        with self.lock:
+            self.callbacks.pop(index, None)
+
+    def update(self, value=None, **kw):
+        spec = self.spec
+        with self.lock:
+            average = self.average
+            if spec.smoothing is not None and average is not None:
+                try:
+                    value = average + spec.smoothing*(value - average)
+                except TypeError:
+                    pass
+            self.average = value
+            try:
+                small = abs(value - self.filtered) < spec.deadband
+            except TypeError:
+                small = value == self.filtered
+            if small or self.held:
+                return
+            wait = self.last + spec.minInterval - self.clock.now()
+            if wait > 0:
+                # Passed on when the interval ends
+                self.held = True
+            else:
+                self.last = self.clock.now()
+                self.filtered = value
+        if wait > 0:
+            self.call_later(wait, self.release)
+        else:
+            self.publish(value)
+
+    def call_later(self, delay, fn):
+        if self.clock.virtual:
+            self.clock.call_later(delay, fn)
+        else:
+            timer = threading.Timer(delay, fn)
+            timer.daemon = True
+            timer.start()
+
+    def release(self):
+        with self.lock:
+            self.held = False
+            value = self.average
+            try:
+                small = abs(value - self.filtered) < self.spec.deadband
+            except TypeError:
+                small = value == self.filtered
+            if small:
+                return
+            self.last = self.clock.now()
+            self.filtered = value
+        self.publish(value)
+
+    def publish(self, value):
+        with self.lock:
+            callbacks = list(self.callbacks.values())
+        for cb in callbacks:
+            cb(pvname=self.pvname, value=value)
+
+def make_input(pool, spec, clock=None):
+    '''
+    Returns the input channel for an entry of an inputs dictionary: the PV
+    of pool for a pvname, or a FilteredInput for an InputFilter
+    '''
+    if isinstance(spec, InputFilter):
+        return FilteredInput(pool.get(spec.channel_name()), spec, clock)
+    return pool.get(spec)
+
+class PVPool:
+    '''
+    Deduplicated pool of epics.PV objects. All the PVs are created on the
+    process Channel Access context, so records built from the same pool by
+    different state machines share one channel per PV name.
+    Methods:
+        -get: Returns the PV object for pvname, creating it on first use
+        -make_records: Builds an input/output dictionary from dictionaries
+        of {name: pvname}. Inputs can also be declared with an InputFilter
+    '''
+    def __init__(self):
+        self.pvs = {}
+        self.lock = threading.Lock()
+
+    def get(self, pvname):
+        with self.lock:
+            pv = self.pvs.get(pvname)
+            if pv is None:
+                import epics
+                pv = epics.get_pv(pvname, connect=False)
+                self.pvs[pvname] = pv
+            return pv
+
+    def make_records(self, inputPVs, outputPVs):
+        inputs = collections.OrderedDict()
+        outputs = collections.OrderedDict()
+        for n in inputPVs:
+            inputs[n] = make_input(self, inputPVs[n])
+        for n in outputPVs:
+            outputs[n] = self.get(outputPVs[n])
+        return {'Input':inputs, 'Output':outputs}
+
+class PutRequest:
+    '''
+    Put queued by an OutputQueue. done is set once the put completed (or
+    failed), and ok tells if it completed successfully.
+    '''
+    def __init__(self, name, pv, value):
+        self.name = name
+        self.pv = pv
+        self.value = value
+        self.done = threading.Event()
+        self.ok = False
+
+class OutputChannel:
+    '''
+    Channel as seen through an OutputQueue: put is queued, every other
+    attribute is taken from the underlying channel.
+    '''
+    def __init__(self, outq, name, pv):
+        self.outq = outq
+        self.name = name
+        self.pv = pv
+
+    def put(self, value):
+        return self.outq.put(self.name, value)
+
+    def __getattr__(self, attr):
+        return getattr(self.pv, attr)
+
+class OutputQueue:
+    '''
+    Non-blocking output layer for the records 'Output' dictionary.
+    Handlers keep using out['NAME'].put(value), which queues the put and
+    returns immediately. A background thread sends the puts in the order they
+    were queued, waiting for the put-completion callback of each one before
+    sending the next, so the write ordering of the sequence is kept.
+    With a VirtualClock the puts are sent right away on the calling thread,
+    keeping the simulation deterministic.
+    Failed puts are reported on log, DEFAULT_LOG if None.
+    Methods:
+        -put: Queues a put and returns its PutRequest
+        -wait: Waits until a PutRequest (or every queued put if none is given)
+        has completed. Returns True if all of them completed successfully,
+        that is, without a given request, if no put failed since the last
+        wait without one
+    '''
+    def __init__(self, outputs, clock=None, log=None):
+        self.outputs = outputs
+        self.clock = clock
+        if log is None:
+            log = DEFAULT_LOG
+        self.log = log
+        self.requests = queue.Queue()
+        self.last = None
+        # Puts that failed since the last wait for every queued put
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def __getitem__(self, name):
+        return OutputChannel(self, name, self.outputs[name])
+
+    def __iter__(self):
+        return iter(self.outputs)
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def put(self, name, value):
+        req = PutRequest(name, self.outputs[name], value)
+        if self.clock is not None and self.clock.virtual:
+            self.last = req
+            self.send_put(req)
+            return req
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.send_puts,
+                                               daemon=True)
+                self.worker.start()
+            self.last = req
+            self.requests.put(req)
+        return req
+
+    def send_puts(self):
+        # Attach to the Channel Access context of the main thread
+        if 'epics' in sys.modules:
+            sys.modules['epics'].ca.use_initial_context()
+        while True:
+            self.send_put(self.requests.get())
+
+    def send_put(self, req):
+        try:
+            ret = req.pv.put(req.value, wait=True, timeout=PUT_TIMEOUT)
+            # pyepics returns None when the channel never connected
+            req.ok = ret is not None and ret > 0
+        except Exception as err:
+            ret = err
+        if not(req.ok):
+            with self.lock:
+                self.failed += 1
+            self.log.emit('error',
+                          'Error: put {0} to {1} did not complete ({2})'.format(
+                              req.value, req.name, ret),
+                          output=req.name, value=req.value)
+        req.done.set()
+
+    def wait(self, req=None, timeout=PUT_TIMEOUT):
+        if req is not None:
+            return req.done.wait(timeout) and req.ok
+        # Puts complete in order, so the last one completes last
+        last = self.last
+        done = last is None or last.done.wait(timeout)
+        with self.lock:
+            failed = self.failed
+            self.failed = 0
+        return done and not(failed)
+
+def flush_outputs(records):
+    '''
+    Waits for the queued puts of records, if its outputs are an OutputQueue
+    '''
+    outputs = records.get('Output')
+    if hasattr(outputs, 'wait'):
+        outputs.wait()
+
+class Histogram:
+    '''
+    Histogram of durations in seconds with fixed bucket upper bounds
+    '''
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+               1.0, 5.0, 10.0, 30.0, 90.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # Last bucket counts observations over the highest bound (+Inf)
+        self.counts = [0]*(len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {'buckets':list(self.buckets), 'counts':list(self.counts),
+                'sum':self.sum, 'count':self.count}
+
+class Metrics:
+    '''
+    Counters and histograms collected by a StateMachine and its States.
+    Every metric is identified by its name and a tuple of (label, value)
+    pairs. Metrics recorded by the engine:
+        -sm_state_entries_total{state}: Times each state was entered
+        -sm_transitions_total{state,target}: Transitions taken
+        -sm_condition_evaluations_total{state}: Evaluations of the
+        transitions table
+        -sm_handler_seconds{state}: Time spent in each handler
+        -sm_transition_wait_seconds{state}: Time spent waiting for a
+        transition to be taken
+        -sm_pv_read_seconds{state}: Time spent reading the input snapshot,
+        only recorded when detailed is True
+    Atributes:
+        -detailed: If False only counters and per-state timings are kept,
+        which is cheap enough to leave on in production. If True the input
+        read latency is also timed on every evaluation
+    Methods:
+        -count: Adds n to a counter
+        -observe: Adds a value to a histogram
+        -to_json: Returns all the metrics as a JSON string
+        -to_prometheus: Returns all the metrics in Prometheus text format
+    '''
+    def __init__(self, detailed=False):
+        self.detailed = detailed
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, labels, n=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def to_json(self):
+        with self.lock:
+            data = {'counters':[{'name':k[0], 'labels':dict(k[1]), 'value':v}
+                                for k, v in sorted(self.counters.items())],
+                    'histograms':[dict(name=k[0], labels=dict(k[1]),
+                                       **h.to_dict())
+                                  for k, h in sorted(self.histograms.items())]}
+        return json.dumps(data)
+
+    def to_prometheus(self):
+        def fmt(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not(labels):
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(k, v)
+                                  for k, v in labels) + '}'
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), v in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE {} counter'.format(name))
+                    typed.add(name)
+                lines.append('{0}{1} {2}'.format(name, fmt(labels), v))
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                total = 0
+                for le, c in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    total += c
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, fmt(labels, [('le', le)]), total))
+                lines.append('{0}_sum{1} {2}'.format(name, fmt(labels), h.sum))
+                lines.append('{0}_count{1} {2}'.format(name, fmt(labels),
+                                                      h.count))
+        return '\n'.join(lines) + '\n'
+
+class DeadlineScheduler:
+    '''
+    Heap of the pending deadlines of a state. Each deadline belongs to a key
+    (an error Transition), and an optional overall deadline applies to every
+    key.
+    Methods:
+        -add: Adds the deadline of key
+        -expired: Returns True if the deadline of key, or the overall
+        deadline, has passed at time now
+        -next_deadline: Drops the deadlines that already passed and returns the
+        earliest pending one, or None if there are none left
+    '''
+    def __init__(self, overall=None):
+        self.heap = []
+        self.deadlines = {}
+        self.seq = itertools.count()
+        self.overall = overall
+        if overall is not None:
+            heapq.heappush(self.heap, (overall, next(self.seq)))
+
+    def add(self, when, key):
+        self.deadlines[key] = when
+        heapq.heappush(self.heap, (when, next(self.seq)))
+
+    def expired(self, key, now):
+        if self.overall is not None and self.overall <= now:
+            return True
+        when = self.deadlines.get(key)
+        return when is not None and when <= now
+
+    def next_deadline(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+def same_value(a, b):
+    '''
+    Returns True if a and b are equal values. Values that can't be compared
+    as a whole, such as waveform arrays, are taken as changed
+    '''
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+class ConditionCache:
+    '''
+    Last result of each transition condition of a State during one
+    run_transitions call. Results of the conditions that declare their
+    inputs (Conditions of SMCondition, and rows written in the condition
+    language) are kept until one of those inputs changes value, so the cost
+    of an evaluation grows with the number of inputs that changed, not with
+    the size of the table. Lambdas and coroutine conditions may read more
+    than the inputs of their row, so they are evaluated every time.
+    Conditions after the first one that is met are not evaluated.
+    Atributes:
+        -results: Result of each transition, None if it has to be evaluated
+        -evals: Number of conditions evaluated
+    Methods:
+        -update: Compares a new snapshot with the previous one and clears the
+        results of the transitions that depend on the inputs that changed
+        -first_match: Updates the cache with a snapshot and returns the first
+        transition, in table order, whose condition is met, or None
+        -async_first_match: Coroutine version of first_match, where the
+        conditions may also be coroutines
+    '''
+    def __init__(self, state):
+        self.transitions = state.transitions
+        self.dependents = state.dependents
+        self.results = [None]*len(self.transitions)
+        self.values = None
+        self.evals = 0
+
+    def update(self, snap):
+        values = dict((n, getattr(v, 'value', v)) for n, v in snap.items())
+        prev = self.values
+        self.values = values
+        if prev is None:
+            return
+        results = self.results
+        for n, v in values.items():
+            if n not in prev or not(same_value(prev[n], v)):
+                for k in self.dependents.get(n, ()):
+                    results[k] = None
+
+    def scan(self, snap):
+        # Shared by first_match and async_first_match: yields each transition
+        # whose condition has to be evaluated, is sent back its result, and
+        # returns the first transition met
+        self.update(snap)
+        results = self.results
+        for k, t in enumerate(self.transitions):
+            r = results[k]
+            if r is None:
+                self.evals += 1
+                r = bool((yield t))
+                if t.cacheable:
+                    results[k] = r
+            if r:
+                return t
+        return None
+
+    def first_match(self, snap):
+        scan = self.scan(snap)
+        try:
+            t = next(scan)
+            while True:
+                t = scan.send(t.test(snap))
+        except StopIteration as stop:
+            return stop.value
+
+    async def async_first_match(self, snap):
+        scan = self.scan(snap)
+        try:
+            t = next(scan)
+            while True:
+                t = scan.send(await resolve(t.test(snap)))
+        except StopIteration as stop:
+            return stop.value
+
+class Transition:
+    '''
+    Compiled row of a transitions array (see State)
+    Atributes:
+        -name: Name of the state to transition to
+        -target: State object to transition to, resolved by
+        StateMachine.compile
+        -targetId: Id of the target State, resolved by StateMachine.compile
+        -inp, cond, error, msg, timeout: Same as in the transitions array
+        row, timeout is None if the row doesn't set it
+        -test: Condition bound to its input names, test(snapshot) evaluates
+        the transition with a single call
+        -inputs: Names of the inputs the condition depends on, from the row
+        and from the condition itself
+        -cacheable: True if the condition declares every input it reads, so
+        its result can be kept until one of them changes (see
+        ConditionCache)
+    '''
+    __slots__ = ('name', 'target', 'targetId', 'inp', 'cond', 'inputs',
+                 'error', 'msg', 'timeout', 'test', 'cacheable')
+
+    def __init__(self, name, inp, cond, error, msg, timeout=None):
+        self.name = sys.intern(name)
+        self.target = None
+        self.targetId = None
+        self.inp = inp
+        self.cond = cond
+        self.inputs = tuple(sys.intern(n)
+                            for n in list(inp) + getattr(cond, 'inputs', [])
+                            if n)
+        self.error = error
+        self.msg = msg
+        self.timeout = timeout
+        # Conditions that name their own inputs (see SMCondition) are
+        # tested without the input names
+        self.test = getattr(cond, 'test', None) or functools.partial(cond, inp)
+        self.cacheable = hasattr(cond, 'test')
+
+    def __repr__(self):
+        return 'Transition({0!r}, error={1})'.format(self.name, self.error)
+
 class State:
     '''
     This class defines a State object to be used by a StateMachine object
     Atributes:
         -name: State name
+        -key: Upper case State name, the key of the state in its StateMachine
         -handler: user defined function that handles state actions
         Function name must follow this structure:
             def STATE_NAME_handler():
@@ -30,111 +943,588 @@ class State:
         -tarray: user array that defines transitions behavior
         The transitions array must have the following structure:
             STATE_NAME_trans =\
-                [[NEXT_STATE, [INPUT_NAMES], CONDITION FUNCTION, ERROR, MESSAGE]]
+                [[NEXT_STATE, [INPUT_NAMES], CONDITION FUNCTION, ERROR, MESSAGE,
+                  (TIMEOUT)]]
             where:
                 STATE_NAME: Name of the current state
                 NEXT_STATE: String for name of the state to transition
                 [INPUT_NAMES]:Array with the name of each input to be used on
                 the condition evaluation function
                 CONDITION_FUNCTION: Lambda function that process the transition
-                based on input values
+                based on input values, a Condition, or a string in the
+                condition language of SMCondition, e.g.
+                'abs(voltAz) > 0.5 or abs(voltEl) > 0.5'. The inputs of
+                Conditions and strings are found by the State, so
+                [INPUT_NAMES] can be left empty
                 ERROR: Boolean that indicates if the state to transition is an
                 error state
                 MESSAGE: A string to be displayed when transition occurs
-        -transitions: Dictionary that contains transitions information for the
-        State
+                TIMEOUT: Optional, only for error transitions. Seconds the
+                error condition has to hold, counted from the moment the
+                state is entered, before the transition is taken
+        -transitions: Tuple of Transition objects, in the same order as the
+        transitions array. Rows with the same next state are all kept
+        -inputNames: Names of all the inputs used by the transitions. All of
+        them are read once into a snapshot before each evaluation of the
+        conditions, so every condition sees the same values
+        -dependents: Dictionary of {input name: indexes of the transitions
+        whose condition reads it}. Conditions that declare their inputs are
+        only re-evaluated when one of them changes (see ConditionCache)
+        -id: Number of the state in its StateMachine, set by compile
+        -metrics: Metrics object where timings are recorded, set by the
+        StateMachine. If None nothing is recorded
+        -clock: Time source for the error timeout, set by the StateMachine
+        -log: EventLog where the transitions taken are written, set by the
+        StateMachine
+        -timeout: Default timeout of the error transitions of this state that
+        don't set their own. If None ERROR_TIME is used
+        -waitStrategy: Wait strategy used while an error transition is
+        active (see wait_until). If None DEFAULT_WAIT is used, which only
+        re-evaluates the conditions when one of the transitions inputs changes
+        -eventDriven: Only used when no waitStrategy is given. If False the
+        conditions are evaluated continuously (CONTINUOUS_WAIT) instead of on
+        monitor updates
 
     Methods:
-        -init_transitions: Fills the State transitions dictionary
-        -run_handler: Runs the handler function using a input/output dictionary
+        -init_transitions: Builds the State transitions from the transitions
+        array, raising InitializationError for malformed rows
+        -run_handler: Runs the handler function using a input/output dictionary,
+        after writing the buffered events of the log, so the output of the
+        handler follows the messages of the State Machine
         -run_transitions: Executes a routines that tests each transition
         condition
+        -async_run_handler, async_run_transitions: Coroutine versions of
+        run_handler and run_transitions, where the handler and the conditions
+        may also be coroutines
+        -input_list: Returns the inputs used by the transitions
+        -read_inputs: Takes the snapshot of the inputs used by the transitions
+        -record_transition: Records the metrics of a transition taken
+        -log_transition: Writes a transition taken to the event log, with the
+        input snapshot that decided it
+        -error_timeout: Returns the timeout of an error transition
+        -error_deadlines: Returns a DeadlineScheduler with the deadlines of
+        the error transitions and the overall run deadline
+        -no_transition: Raises TransitionError for a state that gave up
+        waiting without any transition met
     '''
-    def __init__(self, Name, Handler, Tarray=[], sS=False, eS=False):
-        self.name = Name
+    __slots__ = ('name', 'key', 'handler', 'tarray', 'transitions',
+                 'inputNames', 'dependents', 'id', 'startState', 'endState',
+                 'waitStrategy', 'timeout', 'metrics', 'clock', 'log',
+                 'labels')
+
+    def __init__(self, Name, Handler, Tarray=[], sS=False, eS=False,
+                 waitStrategy=None, timeout=None, eventDriven=True):
+        self.name = sys.intern(Name)
+        self.key = sys.intern(Name.upper())
         self.handler = Handler
         self.tarray = Tarray
         # Very important that transitions are added in order
-        self.transitions = collections.OrderedDict()
+        self.transitions = ()
+        self.inputNames = []
+        self.dependents = {}
+        self.id = None
         self.startState = sS
         self.endState = eS
+        if waitStrategy is None and not(eventDriven):
+            waitStrategy = CONTINUOUS_WAIT
+        self.waitStrategy = waitStrategy
+        self.timeout = timeout
+        self.metrics = None
+        self.clock = DEFAULT_CLOCK
+        self.log = DEFAULT_LOG
+        self.labels = (('state', self.name),)
 
     def init_transitions(self):
+        transitions = []
+        self.inputNames = []
         if not(self.endState):
             for st in self.tarray:
-                self.transitions[st[0]] = {'inp':st[1],
-                                           'cond':st[2],
-                                           'error':st[3],
-                                           'msg':st[4]}
+                if len(st) not in (5, 6):
+                    raise InitializationError(
+                        'Malformed transition {0!r} in {1} state'.format(
+                            st[0], self.name))
+                st = list(st)
+                if isinstance(st[2], str):
+                    st[2] = self.parse_condition(st[0], st[2])
+                if not(callable(st[2])):
+                    raise InitializationError(
+                        'Malformed transition {0!r} in {1} state'.format(
+                            st[0], self.name))
+                t = Transition(*st)
+                transitions.append(t)
                 # print('Transition to {} state ready'.format(st[0]))
+                # Conditions that name their inputs don't need them listed
+                for n in t.inputs:
+                    if n not in self.inputNames:
+                        self.inputNames.append(n)
+        self.transitions = tuple(transitions)
+        dependents = {}
+        for k, t in enumerate(self.transitions):
+            for n in t.inputs:
+                dependents.setdefault(n, []).append(k)
+        self.dependents = dict((n, tuple(ks)) for n, ks in dependents.items())
+
+    def parse_condition(self, target, text):
+        # Imported here, SMCondition depends on this module
+        from SMCondition import parse
+        try:
+            return parse(text)
+        except InitializationError as err:
+            raise InitializationError('{0} in transition to {1} in {2} '
+                                      'state'.format(err.args[0], target,
+                                                     self.name))
 
     def run_handler(self, iod):
         # outp = iod['Output']
+        if self.metrics is None:
+            self.handler(iod)
+            return
+        startTime = time.perf_counter()
         self.handler(iod)
+        self.metrics.observe('sm_handler_seconds', self.labels,
+                             time.perf_counter() - startTime)
+
+    def read_inputs(self, inpt):
+        if self.metrics is None or not(self.metrics.detailed):
+            return take_snapshot(self.inputNames, inpt)
+        startTime = time.perf_counter()
+        snap = take_snapshot(self.inputNames, inpt)
+        self.metrics.observe('sm_pv_read_seconds', self.labels,
+                             time.perf_counter() - startTime)
+        return snap
+
+    def record_transition(self, trans, waitTime, evals):
+        m = self.metrics
+        m.count('sm_condition_evaluations_total', self.labels, evals)
+        m.observe('sm_transition_wait_seconds', self.labels, waitTime)
+        m.count('sm_transitions_total',
+                self.labels + (('target', trans.name),))
+        m.count('sm_state_entries_total', (('state', trans.target.name),))
+
+    def log_transition(self, trans, snap, waitTime, runId):
+        inputs = dict((n, getattr(v, 'value', v))
+                      for n, v in (snap or {}).items())
+        self.log.emit('transition', trans.msg or None, run=runId,
+                      clock=self.clock.now(), state=self.name,
+                      target=trans.name, error=trans.error, wait=waitTime,
+                      inputs=inputs)
+
+    def input_list(self, inpt):
+        return [inpt[n] for n in self.inputNames if n in inpt]
+
+    def error_timeout(self, trans):
+        if trans.timeout is not None:
+            return trans.timeout
+        if self.timeout is not None:
+            return self.timeout
+        return ERROR_TIME
 
-    def run_transitions(self, iod):
-        waitTime = 0
+    def error_deadlines(self, deadline):
+        now = self.clock.now()
+        deadlines = DeadlineScheduler(deadline)
+        for t in self.transitions:
+            if t.error:
+                deadlines.add(now + self.error_timeout(t), t)
+        if not(deadlines.deadlines):
+            # Without error transitions the state still gives up waiting
+            timeout = ERROR_TIME if self.timeout is None else self.timeout
+            deadlines.add(now + timeout, self)
+        return deadlines
+
+    def no_transition(self):
+        raise TransitionError(
+            'No transition of {} state was met before its deadlines '
+            'expired'.format(self.name))
+
+    def run_transitions(self, iod, deadline=None, runId=None):
         inpt = iod['Input']
-        tt = self.transitions
-        startTime = datetime.now()
+        nextTrans = None
+        snap = None
+        clock = self.clock
+        deadlines = self.error_deadlines(deadline)
+        cache = ConditionCache(self)
+
+        def decided():
+            nonlocal nextTrans, snap
+            snap = self.read_inputs(inpt)
+            t = cache.first_match(snap)
+            if t is None:
+                return False
+            nextTrans = t
+            return not(t.error) or deadlines.expired(t, clock.now())
+
+        startTime = time.perf_counter()
+        inputs = self.input_list(inpt)
         while True:
-            for ns in tt:
-                if tt[ns]['cond'](tt[ns]['inp'],inpt):
-                    nextState = ns
-                    break
-            waitTime = (datetime.now() - startTime).total_seconds()
-            if not(tt[nextState]['error']) or waitTime > ERROR_TIME:
+            # Wait for a decision or until the next deadline, whichever
+            # comes first
+            nextDeadline = deadlines.next_deadline(clock.now())
+            if nextDeadline is None:
+                decided()
                 break
-        msg = tt[nextState]['msg']
-        if msg:
-            print(msg)
-        return nextState
+            if wait_until(decided, inputs, nextDeadline - clock.now(),
+                          self.waitStrategy, clock):
+                break
+        if nextTrans is None:
+            self.no_transition()
+        waitTime = time.perf_counter() - startTime
+        if self.metrics is not None:
+            self.record_transition(nextTrans, waitTime, cache.evals)
+        self.log_transition(nextTrans, snap, waitTime, runId)
+        return nextTrans
+
+    async def async_run_handler(self, iod):
+        if self.metrics is None:
+            await resolve(self.handler(iod))
+            return
+        startTime = time.perf_counter()
+        await resolve(self.handler(iod))
+        self.metrics.observe('sm_handler_seconds', self.labels,
+                             time.perf_counter() - startTime)
+
+    async def async_run_transitions(self, iod, deadline=None, runId=None):
+        inpt = iod['Input']
+        nextTrans = None
+        snap = None
+        clock = self.clock
+        deadlines = self.error_deadlines(deadline)
+        cache = ConditionCache(self)
+
+        async def decided():
+            nonlocal nextTrans, snap
+            snap = self.read_inputs(inpt)
+            t = await cache.async_first_match(snap)
+            if t is None:
+                return False
+            nextTrans = t
+            return not(t.error) or deadlines.expired(t, clock.now())
+
+        startTime = time.perf_counter()
+        inputs = self.input_list(inpt)
+        while True:
+            nextDeadline = deadlines.next_deadline(clock.now())
+            if nextDeadline is None:
+                await decided()
+                break
+            if await async_wait_until(decided, inputs,
+                                      nextDeadline - clock.now()):
+                break
+        if nextTrans is None:
+            self.no_transition()
+        waitTime = time.perf_counter() - startTime
+        if self.metrics is not None:
+            self.record_transition(nextTrans, waitTime, cache.evals)
+        self.log_transition(nextTrans, snap, waitTime, runId)
+        return nextTrans
+
+# Inputs that belong to each run instead of the shared records
+RUN_INPUTS = ('prevState',)
+
+def log_message(records, text, **fields):
+    '''
+    Writes the message of a handler to the event log of its run, so it comes
+    out in order with the messages of the State Machine. Records that don't
+    belong to a run write to DEFAULT_LOG
+    '''
+    records.get('Log', DEFAULT_LOG).emit('message', text, **fields)
+
+class Run:
+    '''
+    Context of one run of a StateMachine, kept apart from the machine
+    definition, so any number of runs can share the same States and
+    Transitions, one after the other or at the same time
+    Atributes:
+        -runId: Id of the run, carried by all its events
+        -state: Id of the current state
+        -previous: Id of the state before the current one, None on the Start
+        State
+        -history: List of the ids of the states entered, starting with the
+        Start State
+        -steps: Number of transitions taken
+        -startTime: Clock time when the run started
+        -enteredTime: Clock time when the current state was entered
+        -deadline: Clock time of the overall deadline, None if the run has
+        none
+        -resumedFrom: Id of the interrupted run this run continues, None if
+        it started on the Start State
+        -records: Input/output dictionary seen by the handlers and
+        conditions of this run. Its Input is a ChainMap of the run inputs
+        (RUN_INPUTS, e.g. prevState) over the shared inputs, so the run
+        never writes to the shared records. Its Log is the event log of the
+        run, which handlers write their messages to with log_message
+    Methods:
+        -enter: Moves the run to the state with the given id
+    '''
+    __slots__ = ('runId', 'state', 'previous', 'history', 'steps',
+                 'startTime', 'enteredTime', 'deadline', 'resumedFrom',
+                 'records')
+
+    def __init__(self, runId, state, now, deadline=None, records=None,
+                 log=None):
+        self.runId = runId
+        self.state = state
+        self.previous = None
+        self.history = [state]
+        self.steps = 0
+        self.startTime = now
+        self.enteredTime = now
+        self.deadline = deadline
+        self.resumedFrom = None
+        if records is None:
+            records = {'Input':{}, 'Output':{}}
+        local = dict.fromkeys(RUN_INPUTS, '')
+        self.records = {'Input':collections.ChainMap(local, records['Input']),
+                        'Output':records['Output'],
+                        'Log':DEFAULT_LOG if log is None else log}
+
+    def __repr__(self):
+        return 'Run({0!r}, state={1}, steps={2})'.format(
+            self.runId, self.state, self.steps)
+
+    def enter(self, state, now):
+        self.previous = self.state
+        self.state = state
+        self.history.append(state)
+        self.enteredTime = now
+        self.steps += 1
 
 class StateMachine:
-    def __init__(self):
+    '''
+    This class runs a set of State objects, starting on the Start State and
+    following the transitions until an End State is reached. The
+    StateMachine and its States only hold the definition of the machine;
+    everything that changes during a run is kept in a Run, so one
+    StateMachine is built once and runs any number of times, also for
+    different records
+    Atributes:
+        -states: Dictionary of {upper case state name: State}
+        -stateList: Tuple of the States indexed by their id, set by compile
+        -startState, endStates: Upper case names of the Start and End States
+        -runHandlers: If True, the handler of each state is executed when the
+        state is entered
+        -metrics: Metrics object shared by all the states. If None no metrics
+        are recorded
+        -clock: Time source for timeouts and deadlines, MonotonicClock or
+        VirtualClock. If None DEFAULT_CLOCK is used. AsyncStateMachine
+        waits on the event loop time, so it only supports real clocks
+        -timeout: Default overall deadline of a run, in seconds from the
+        start. Used when run or run_sequence get no timeout. If None the run
+        has no overall deadline
+        -log: EventLog shared by all the states, see SMEventLog. If None
+        DEFAULT_LOG is used, which writes the messages to stdout
+        -graph: StateGraph of the State Machine, built by validate
+        -checkpoint: Object with a save(sm, run, end) method called when a
+        run starts and on every state it enters, e.g. an SMCheckpoint
+        Checkpoint. If None nothing is saved
+
+    Methods:
+        -add_state: Adds a State object to the State Machine
+        -compile: Resolves the target State of every transition, raising
+        InitializationError for unknown state names, and numbers the states
+        in the order they were added
+        -validate: Raises InitializationError if the State Machine can't run:
+        no Start or End State, transitions to unknown states, states without
+        transitions or states that can't reach an End State (see SMGraph).
+        If records are given, also checks that every input used by the
+        transitions exists in them or in RUN_INPUTS
+        -connect: Waits for all the channels in records to connect, raising
+        InitializationError with the list of channels that failed
+        -run: Validates the State Machine and connects the channels, printing
+        the error and exiting if any of them fails, then calls run_sequence
+        -new_run: Returns the Run of a new run on the Start State, bound to
+        records
+        -start_run, enter_state: Write the start of a run and each state
+        entered to the event log, keeping its Run up to date
+        -run_sequence: Runs the State Machine until an End State is reached
+        and returns its name. If timeout is given, once it expires every
+        pending error transition is taken without waiting for its own
+        timeout. If a Run is given (see new_run) it is used instead of a new
+        one, and is kept up to date as the run goes on
+    '''
+    __slots__ = ('states', 'stateList', 'startState', 'endStates',
+                 'runHandlers', 'metrics', 'clock', 'timeout', 'log', 'graph',
+                 'checkpoint')
+
+    def __init__(self, runHandlers=False, metrics=None, clock=None,
+                 timeout=None, log=None):
         self.states = {}
+        self.stateList = ()
         self.startState = None
         self.endStates = []
-        self.prevState = ''
+        self.runHandlers = runHandlers
+        self.metrics = metrics
+        if clock is None:
+            clock = DEFAULT_CLOCK
+        self.clock = clock
+        self.timeout = timeout
+        if log is None:
+            log = DEFAULT_LOG
+        self.log = log
+        self.graph = None
+        self.checkpoint = None
 
     def add_state(self, state):
-        name = state.name.upper()
+        name = state.key
         self.states[name] = state
-        print('Added {} state to State Machine'.format(name))
+        self.log.emit('state_added',
+                      'Added {} state to State Machine'.format(name),
+                      state=state.name)
         if state.startState:
             try:
                 if self.startState:
                     raise InitializationError('More than one Start State defined')
             except InitializationError as err:
-                print(err.message)
+                self.log.emit('error', err.message)
                 exit(0)
             self.startState = name
         if state.endState:
             self.endStates.append(name)
 
-    def run(self, records):
+    def compile(self):
+        self.stateList = tuple(self.states.values())
+        for i, state in enumerate(self.stateList):
+            state.id = i
+        for state in self.stateList:
+            state.metrics = self.metrics
+            state.clock = self.clock
+            state.log = self.log
+            for t in state.transitions:
+                target = self.states.get(t.name.upper())
+                if target is None:
+                    raise InitializationError(
+                        'Unknown state {0} in {1} state transitions'.format(
+                            t.name, state.name))
+                t.target = target
+                t.targetId = target.id
+
+    def validate(self, records=None):
+        if not(self.startState):
+            raise InitializationError('No Start State defined')
+        if not(self.endStates):
+            raise InitializationError('No End State defined')
+        # Imported here, SMGraph depends on this module
+        from SMGraph import StateGraph
+        self.graph = StateGraph(self)
+        self.graph.check()
+        self.compile()
+        if records is not None:
+            for state in self.stateList:
+                for n in state.inputNames:
+                    if n not in records['Input'] and n not in RUN_INPUTS:
+                        raise InitializationError(
+                            'Unknown input {0} in {1} state transitions'.format(
+                                n, state.name))
+
+    def connect(self, records, timeout=CONNECT_TIME):
+        failed = connect_channels(records, timeout)
+        if failed:
+            raise InitializationError(
+                'Channels not connected: {}'.format(', '.join(failed)))
+
+    def run(self, records, timeout=None, connTimeout=CONNECT_TIME,
+            run=None):
         try:
-            if not(self.startState):
-                raise InitializationError('No Start State defined')
-            if not(self.endStates):
-                raise InitializationError('No End State defined')
+            self.validate(records)
+            self.connect(records, connTimeout)
         except InitializationError as err:
-            print(err.message)
+            self.log.emit('error', err.message)
             exit(0)
-        currState = self.states[self.startState]
-        self.prevState = self.startState
+        return self.run_sequence(records, timeout, run)
+
+    def new_run(self, records, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        now = self.clock.now()
+        deadline = None
+        if timeout is not None:
+            deadline = now + timeout
+        return Run(self.log.new_run(), self.states[self.startState].id, now,
+                   deadline, records, self.log)
+
+    def start_run(self, run, timeout):
+        self.log.emit('run_start', run=run.runId, clock=run.startTime,
+                      state=self.stateList[run.state].name, timeout=timeout)
+        if self.metrics is not None:
+            self.metrics.count('sm_state_entries_total',
+                               self.stateList[run.state].labels)
+        if self.checkpoint is not None:
+            self.checkpoint.save(self, run)
+
+    def enter_state(self, run, trans):
+        # Moves the run to the target of trans and returns True if it is an
+        # End State
+        run.enter(trans.targetId, self.clock.now())
+        run.records['Input']['prevState'] = self.stateList[run.previous].name
+        currState = trans.target
+        if self.checkpoint is not None:
+            self.checkpoint.save(self, run, currState.endState)
+        if currState.endState:
+            self.log.emit('run_end',
+                          'Recovery ended on {0}'.format(currState.key),
+                          run=run.runId, clock=run.enteredTime,
+                          state=currState.name)
+            return True
+        self.log.emit('state_enter',
+                      'Recovery in {0} state'.format(currState.key),
+                      run=run.runId, clock=run.enteredTime,
+                      state=currState.name)
+        return False
+
+    def run_sequence(self, records, timeout=None, run=None):
+        if run is None:
+            run = self.new_run(records, timeout)
+        self.start_run(run, timeout if timeout is not None else self.timeout)
+        records = run.records
+        currState = self.stateList[run.state]
         while True:
-            # currState.run_handler(records)
-            newState = currState.run_transitions(records)
-            records['Input']['prevState'] = self.prevState
-            self.prevState = newState
-            currState = self.states[newState.upper()]
-            if newState.upper() in self.endStates:
-                print("Recovery ended on {0}".format(newState.upper()))
-                # currState.run_handler(records)
-                break
-            else:
-                print("Recovery in {0} state".format(newState.upper()))
+            if self.runHandlers:
+                currState.run_handler(records)
+            trans = currState.run_transitions(records, run.deadline,
+                                              run.runId)
+            currState = trans.target
+            if self.enter_state(run, trans):
+                if self.runHandlers:
+                    currState.run_handler(records)
+                flush_outputs(records)
+                self.log.flush()
+                return currState.name
+
+class AsyncStateMachine(StateMachine):
+    '''
+    StateMachine that runs as a coroutine, so it can share an event loop with
+    other tasks. Handlers and transition conditions may be plain functions or
+    coroutine functions; waits on inputs never block the loop.
+    Usage:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(sm.run(records))
+    '''
+    __slots__ = ()
+
+    async def run(self, records, timeout=None, connTimeout=CONNECT_TIME,
+                  run=None):
+        import asyncio
+        self.validate(records)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.connect, records, connTimeout)
+        if run is None:
+            run = self.new_run(records, timeout)
+        self.start_run(run, timeout if timeout is not None else self.timeout)
+        records = run.records
+        currState = self.stateList[run.state]
+        while True:
+            if self.runHandlers:
+                await currState.async_run_handler(records)
+            trans = await currState.async_run_transitions(records,
+                                                         run.deadline,
+                                                         run.runId)
+            currState = trans.target
+            if self.enter_state(run, trans):
+                if self.runHandlers:
+                    await currState.async_run_handler(records)
+                # Both block, on the puts and on the sinks
+                await loop.run_in_executor(None, flush_outputs, records)
+                await loop.run_in_executor(None, self.log.flush)
+                return currState.name
 
 if __name__ == '__main__':
     pass
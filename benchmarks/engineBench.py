@@ -0,0 +1,422 @@
+#!/usr/bin/env python3.5
+'''
+Benchmark suite for the State Machine engine, running on simulated channels
+(SMSim), so it needs neither an IOC nor a network.
+Measures:
+    -reaction: time from an input update to the end of run_transitions, for
+    each wait strategy
+    -wait_cpu: CPU time used by a state waiting on an error transition, as a
+    fraction of the wall time, with a 50 Hz noisy input
+    -throughput: transitions per second through a long chain of states
+    -nzsf: end-to-end time of the NZSF recovery with the transition tables
+    of nzsfRecovery.py and a simulated telescope
+    -nzsf_virtual: NZSF recoveries in simulated time (VirtualClock), where
+    the azimuth drive never asserts, so each run ends on the error path once
+    the drive timeout of that transition expires
+    -batch: decisions per second of a state evaluated for many machines, one
+    snapshot at a time with lambdas and in one pass with BatchEvaluator
+    -incremental: condition evaluations per input update in a state with a
+    large table where only one input is noisy, in simulated time
+    -filter: wakeups of a state waiting on a noisy analog input, with and
+    without the deadband and minimum interval of an InputFilter, in
+    simulated time
+    -daemon: time from a non zero speed fault to the first put of the
+    recovery with a resident Daemon running the handlers (as with
+    nzsfRecovery.py --daemon --run-handlers) and no debounce, and faults
+    shorter than the debounce time that are ignored
+    -checkpoint: time to append a checkpoint record, as done on every
+    transition, and to resume the interrupted run from a checkpoint file
+    -footprint: memory of the NZSF machine definition, and memory and
+    start time of each run sharing it
+Usage:
+    python3 benchmarks/engineBench.py [-n TRIALS] [--json FILE] [BENCH ...]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import StateMachineLib as sml
+from SMSim import SimBackend
+
+STRATEGIES = [('monitor', sml.MonitorWait()),
+              ('backoff', sml.BackoffWait()),
+              ('fixed_rate', sml.FixedRateWait())]
+
+def quiet():
+    return contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p*len(values)))]
+
+def waiting_state(strategy):
+    tarray = [['error', ['inp'], lambda n,i: i[n[0]].value != 0, True, ''],
+              ['done', [''], lambda n,i: True, False, '']]
+    s = sml.State('wait', None, tarray, waitStrategy=strategy)
+    s.init_transitions()
+    return s
+
+def bench_reaction(trials):
+    results = {}
+    for name, strategy in STRATEGIES:
+        sim = SimBackend()
+        pv = sim.get('sim:inp')
+        sim.start()
+        state = waiting_state(strategy)
+        recs = {'Input':{'inp':pv}}
+        stamps = []
+        latencies = []
+        for i in range(trials):
+            pv.post(1)
+            sim.call_later(0.01, lambda: (stamps.append(time.perf_counter()),
+                                          pv.post(0)))
+            state.run_transitions(recs, time.monotonic() + 1.0)
+            latencies.append(time.perf_counter() - stamps[-1])
+        sim.stop()
+        results[name] = {'median_ms':percentile(latencies, 0.5)*1000,
+                         'p99_ms':percentile(latencies, 0.99)*1000}
+    return results
+
+def bench_wait_cpu(trials):
+    results = {}
+    for name, strategy in STRATEGIES:
+        sim = SimBackend()
+        pv = sim.get('sim:inp')
+        pv.value = 1
+        sim.periodic('sim:inp', 50, lambda t: 1 + 0.001*(int(t*50) % 2))
+        sim.start()
+        state = waiting_state(strategy)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        state.run_transitions({'Input':{'inp':pv}}, time.monotonic() + 1.0)
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+        sim.stop()
+        results[name] = {'cpu_fraction':cpu/wall}
+    return results
+
+def bench_throughput(trials):
+    length = 100*trials
+    sm = sml.StateMachine()
+    true = lambda n,i: True
+    with quiet():
+        for k in range(length + 1):
+            nxt = 's{}'.format(k + 1) if k < length else 'end'
+            s = sml.State('s{}'.format(k), None, [[nxt, [''], true, False, '']],
+                          sS=(k == 0))
+            s.init_transitions()
+            sm.add_state(s)
+        sm.add_state(sml.State('end', None, eS=True))
+        recs = {'Input':{}, 'Output':{}}
+        sm.validate(recs)
+        startTime = time.perf_counter()
+        sm.run_sequence(recs)
+        elapsed = time.perf_counter() - startTime
+    return {'transitions_per_s':(length + 1)/elapsed}
+
+def simulated_telescope(sim, recs, delay=0.05, azFails=False):
+    '''
+    Scripts the hardware reactions of the NZSF recovery on simulated channels.
+    If azFails is True the azimuth drive ignores the assert command.
+    '''
+    inp = recs['Input']
+    out = recs['Output'].outputs
+    # Filtered inputs are scripted through their simulated channel
+    sims = dict((n, getattr(pv, 'pv', pv)) for n, pv in inp.items())
+
+    def follow(pv, value):
+        on = out['tcsMCSFollow'].value == 'On'
+        sim.call_later(delay, sims['mcsFollow'].post, int(on))
+
+    def reset(pv, value):
+        for n in ('voltAz', 'voltEl', 'nzsAz', 'nzsEl'):
+            sim.call_later(delay, sims[n].post, 0)
+
+    def drive(cond):
+        def react(pv, value):
+            if not(azFails and cond == 'azDriveCond' and value == 2):
+                sim.call_later(4*delay, sims[cond].post, value)
+        return react
+
+    out['tcsApply'].on_put = follow
+    out['f1Reset'].on_put = reset
+    out['azDriveEn'].on_put = drive('azDriveCond')
+    out['elDriveEn'].on_put = drive('elDriveCond')
+    for n, v in (('nzsAz', 1), ('voltAz', 0.8), ('mcsFollow', 1),
+                 ('azDriveCond', 2), ('elDriveCond', 2)):
+        sims[n].value = v
+
+def run_nzsf(clock=None, azFails=False):
+    import nzsfRecovery
+    sim = SimBackend(clock=clock)
+    with quiet():
+        sm = nzsfRecovery.build_state_machine(clock)
+        sm.runHandlers = True
+        recs = nzsfRecovery.make_records(sim, clock)
+        simulated_telescope(sim, recs, azFails=azFails)
+        sim.start()
+        end = sm.run(recs)
+    sim.stop()
+    return end
+
+def bench_nzsf(trials):
+    times = []
+    paths = set()
+    for i in range(max(1, trials//10)):
+        startTime = time.perf_counter()
+        paths.add(run_nzsf())
+        times.append(time.perf_counter() - startTime)
+    return {'median_s':percentile(times, 0.5), 'end_states':sorted(paths)}
+
+def bench_nzsf_virtual(trials):
+    paths = set()
+    simulated = 0
+    startTime = time.perf_counter()
+    for i in range(trials):
+        clock = sml.VirtualClock()
+        paths.add(run_nzsf(clock, azFails=True))
+        simulated += clock.now()
+    elapsed = time.perf_counter() - startTime
+    return {'runs_per_s':trials/elapsed, 'simulated_s_per_run':simulated/trials,
+            'end_states':sorted(paths)}
+
+def bench_batch(trials):
+    import random
+    from SMCondition import (Condition, Input, Const, Abs, Compare, Or,
+                             ALWAYS, BatchEvaluator, snapshot_columns)
+
+    def over(n, limit):
+        return Compare('>', Abs(Input(n)), Const(limit))
+
+    lambdas = sml.State('lambdas', None,
+        [['rec_error', ['voltAz', 'voltEl'],
+          lambda n,i: abs(i[n[0]].value) > 0.1 or abs(i[n[1]].value) > 0.1,
+          True, ''],
+         ['clear_nzsf', [''], lambda n,i: True, False, '']])
+    conds = sml.State('conditions', None,
+        [['rec_error', ['voltAz', 'voltEl'],
+          Condition(Or(over('voltAz', 0.1), over('voltEl', 0.1))), True, ''],
+         ['clear_nzsf', [''], ALWAYS, False, '']])
+    lambdas.init_transitions()
+    conds.init_transitions()
+    machines = 1000*trials
+    snaps = [{'voltAz':sml.Sample(random.uniform(-0.2, 0.2)),
+              'voltEl':sml.Sample(random.uniform(-0.2, 0.2))}
+             for k in range(machines)]
+    startTime = time.perf_counter()
+    expected = []
+    for snap in snaps:
+        for t in lambdas.transitions:
+            if t.test(snap):
+                expected.append(t.name)
+                break
+    scalar = time.perf_counter() - startTime
+    cols = snapshot_columns(snaps, conds.inputNames)
+    batch = BatchEvaluator(conds)
+    startTime = time.perf_counter()
+    rows = batch.decide(cols, machines)
+    vector = time.perf_counter() - startTime
+    assert [conds.transitions[k].name for k in rows] == expected
+    return {'machines':machines, 'scalar_per_s':machines/scalar,
+            'batch_per_s':machines/vector}
+
+def bench_incremental(trials):
+    rows = 10*trials
+    clock = sml.VirtualClock()
+    sim = SimBackend(clock=clock)
+    # Rows in the condition language declare their inputs, so their
+    # results are cached
+    tarray = [['s{}'.format(k), [], 'in{} > 10'.format(k), False, '']
+              for k in range(rows)]
+    tarray.append(['error', [], 'True', True, '', 10.0])
+    state = sml.State('wait', None, tarray)
+    state.init_transitions()
+    for t in state.transitions:
+        t.target = state
+    state.clock = clock
+    state.metrics = sml.Metrics()
+    recs = {'Input':dict(('in{}'.format(k), sim.get('in{}'.format(k)))
+                         for k in range(rows))}
+    sim.periodic('in0', 50, lambda t: int(t*50) % 2)
+    sim.start()
+    state.run_transitions(recs)
+    sim.stop()
+    metrics = json.loads(state.metrics.to_json())
+    evals = sum(m['value'] for m in metrics['counters']
+                if m['name'] == 'sm_condition_evaluations_total')
+    return {'rows':rows + 1, 'updates':10*50,
+            'evals_per_update':evals/(10*50)}
+
+def bench_filter(trials):
+    import random
+    results = {}
+    for name, spec in (('raw', 'sim:volt'),
+                       ('filtered', sml.InputFilter('sim:volt', 0.01, 0.1))):
+        clock = sml.VirtualClock()
+        sim = SimBackend(clock=clock)
+        recs = sim.make_records({'volt':spec}, {})
+        rng = random.Random(1)
+        # 200 Hz noise around 0.3, dropping to 0 after 10 s
+        sim.periodic('sim:volt', 200,
+                     lambda t: (0.3 if t < 10 else 0) + rng.gauss(0, 0.002))
+        sim.start()
+        wakeups = 0
+
+        def low(n, i):
+            nonlocal wakeups
+            wakeups += 1
+            return abs(i[n[0]].value) > 0.1
+
+        state = sml.State('wait', None,
+                          [['error', ['volt'], low, True, '', 10*trials],
+                           ['done', [''], lambda n,i: True, False, '']])
+        state.init_transitions()
+        state.clock = clock
+        state.run_transitions(recs)
+        sim.stop()
+        results[name] = {'wakeups':wakeups, 'decided_s':clock.now()}
+    return results
+
+def bench_daemon(trials):
+    import threading
+    import nzsfRecovery
+    from SMDaemon import Daemon
+    sim = SimBackend()
+    with quiet():
+        sm = nzsfRecovery.build_state_machine()
+        sm.runHandlers = True
+        recs = nzsfRecovery.make_records(sim)
+        simulated_telescope(sim, recs)
+        out = recs['Output'].outputs
+        nzsAz = recs['Input']['nzsAz']
+        nzsAz.value = 0
+        firstPut = threading.Event()
+        for pv in out.values():
+            react = pv.on_put
+
+            def on_put(pv, value, react=react):
+                firstPut.set()
+                if react is not None:
+                    react(pv, value)
+            pv.on_put = on_put
+        sim.start()
+        daemon = Daemon(sm, recs, nzsfRecovery.TRIGGERS, debounce=0)
+        daemon.start()
+        times = []
+        for i in range(max(1, trials//10)):
+            firstPut.clear()
+            done = len(daemon.results)
+            startTime = time.perf_counter()
+            nzsAz.post(1)
+            firstPut.wait(5.0)
+            times.append(time.perf_counter() - startTime)
+            while len(daemon.results) == done or nzsAz.value:
+                time.sleep(0.01)
+            # The simulated reset cleared the fault, put the telescope back
+            # in the same state for the next one
+            for n, v in (('voltAz', 0.8), ('mcsFollow', 1),
+                         ('azDriveCond', 2), ('elDriveCond', 2)):
+                getattr(recs['Input'][n], 'pv', recs['Input'][n]).post(v)
+        runs = len(daemon.results)
+        daemon.debounce = 0.1
+        for i in range(trials):
+            nzsAz.post(1)
+            nzsAz.post(0)
+        time.sleep(0.2)
+        daemon.stop()
+    sim.stop()
+    return {'fault_to_put_ms':percentile(times, 0.5)*1e3,
+            'end_states':sorted(set(r for i, r in daemon.results)),
+            'glitches':trials, 'glitch_runs':len(daemon.results) - runs}
+
+def bench_checkpoint(trials):
+    import tempfile
+    import nzsfRecovery
+    from SMEventLog import EventLog
+    from SMCheckpoint import Checkpoint
+    sm = nzsfRecovery.build_state_machine(log=EventLog([]))
+    recs = nzsfRecovery.make_records(SimBackend())
+    sm.compile()
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = Checkpoint(os.path.join(tmp, 'nzsf.ckpt'))
+        count = 1000*trials
+        states = len(sm.stateList)
+        startTime = time.perf_counter()
+        for i in range(count):
+            # Runs as long as the nzsf sequence, the last one interrupted
+            if not(i % states):
+                run = sm.new_run(recs)
+            else:
+                run.enter(i % states, sm.clock.now())
+            checkpoint.save(sm, run, (i + 1) % states == 0 and i + 1 < count)
+        save = (time.perf_counter() - startTime)/count
+        times = []
+        for i in range(trials):
+            startTime = time.perf_counter()
+            resumed = checkpoint.resume(sm, recs)
+            times.append(time.perf_counter() - startTime)
+        checkpoint.close()
+    return {'save_us':save*1e6, 'resume_ms':percentile(times, 0.5)*1e3,
+            'records':count, 'resumed_steps':resumed.steps}
+
+def bench_footprint(trials):
+    import tracemalloc
+    import nzsfRecovery
+    from SMEventLog import EventLog
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sm = nzsfRecovery.build_state_machine(log=EventLog([]))
+    sm.compile()
+    definition = tracemalloc.get_traced_memory()[0] - before
+    recs = nzsfRecovery.make_records(SimBackend())
+    before = tracemalloc.get_traced_memory()[0]
+    runs = [sm.new_run(recs) for i in range(1000)]
+    perRun = (tracemalloc.get_traced_memory()[0] - before) / len(runs)
+    tracemalloc.stop()
+    count = 1000*trials
+    startTime = time.perf_counter()
+    for i in range(count):
+        sm.new_run(recs)
+    newRun = (time.perf_counter() - startTime)/count
+    transitions = sum(len(st.transitions) for st in sm.stateList)
+    return {'states':len(sm.stateList), 'transitions':transitions,
+            'definition_bytes':definition, 'run_bytes':perRun,
+            'new_run_us':newRun*1e6}
+
+BENCHES = [('reaction', bench_reaction),
+           ('wait_cpu', bench_wait_cpu),
+           ('throughput', bench_throughput),
+           ('nzsf', bench_nzsf),
+           ('nzsf_virtual', bench_nzsf_virtual),
+           ('batch', bench_batch),
+           ('incremental', bench_incremental),
+           ('filter', bench_filter),
+           ('daemon', bench_daemon),
+           ('checkpoint', bench_checkpoint),
+           ('footprint', bench_footprint)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Engine benchmarks')
+    parser.add_argument('benches', nargs='*',
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('-n', '--trials', type=int, default=50,
+                        help='Trials per benchmark')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+    results = {}
+    for name, bench in BENCHES:
+        if args.benches and name not in args.benches:
+            continue
+        results[name] = bench(args.trials)
+        print('{0:<12} {1}'.format(name, json.dumps(results[name],
+                                                    sort_keys=True)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3.5
+'''
+Startup time benchmark for the State Machine library and recovery scripts.
+Each module is imported in a fresh interpreter several times and the median
+time spent in the import statement is reported. The run
+fails (exit code 1) if a module goes over its time budget or pulls in one of
+the heavy modules that must only be loaded on demand.
+Usage:
+    python3 benchmarks/startupBench.py [-n RUNS] [-b BUDGET_MS]
+'''
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that are only imported when a feature needs them
+HEAVY_MODULES = ['epics', 'numpy', 'h5py', 'asyncio', 'inspect']
+
+# Modules to import, each one on its own interpreter
+TARGETS = ['StateMachineLib', 'nzsfRecovery', 'SMSupervisor', 'SMDaemon',
+           'SMCheckpoint']
+
+PROBE = '''
+import sys, time, json
+t0 = time.perf_counter()
+{imp}
+t1 = time.perf_counter()
+print(json.dumps({{'time': t1 - t0,
+                  'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+def probe(module):
+    imp = 'import {}'.format(module)
+    code = PROBE.format(imp=imp, heavy=HEAVY_MODULES)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=REPO_DIR)
+    return json.loads(out.decode())
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def run(runs, budget):
+    failed = False
+    for module in TARGETS:
+        results = [probe(module) for i in range(runs)]
+        ms = median([r['time'] for r in results])*1000
+        loaded = results[0]['loaded']
+        status = 'OK'
+        if ms > budget or loaded:
+            status = 'FAIL'
+            failed = True
+        print('{0:<20} {1:8.2f} ms  heavy: {2:<20} {3}'.format(
+            module, ms, ','.join(loaded) or '-', status))
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('-n', '--runs', type=int, default=7,
+                        help='Imports per module')
+    parser.add_argument('-b', '--budget', type=float, default=50.0,
+                        help='Maximum median import time in ms')
+    args = parser.parse_args()
+    sys.exit(1 if run(args.runs, args.budget) else 0)
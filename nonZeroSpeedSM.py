@@ -1,17 +1,15 @@
 #!/usr/bin/env python3.5
 
-import os
-import argparse
 import epics
-import time
-import h5py
-import re
-import numpy as np
-import collections
 
-from datetime import datetime, timedelta
+from StateMachineLib import wait_until, MonitorWait, OutputQueue
+from StateMachineLib import MonotonicClock
 
 ERROR_TIME = 1.5*60
+# Strategy used by every state to wait for the hardware to respond
+WAIT_STRATEGY = MonitorWait()
+# Time source for every wait, sleep and deadline of the states
+CLOCK = MonotonicClock()
 Recs = {}
 inputs = {}
 outputs = {}
@@ -48,7 +46,7 @@ outputs['azDriveEn'] = epics.PV('mc:azDriveEnable')
 outputs['elDriveEn'] = epics.PV('mc:elDriveEnable')
 
 Recs['Input'] = inputs
-Recs['Output'] = outputs
+Recs['Output'] = OutputQueue(outputs, CLOCK)
 
 class InitializationError(Exception):
     def __init__(self, message):
@@ -69,13 +67,13 @@ class State:
         waitTime = 0
         inpt = iod['Input']
         tt = self.transitions
-        startTime = datetime.now()
+        startTime = CLOCK.now()
         while True:
             for ns in tt:
                 if ns['cond'](ns['inp'],inpt):
                     nextState = ns
                     break
-            waitTime = (datetime.now() - startTime).total_seconds()
+            waitTime = CLOCK.now() - startTime
             if not(tt[nextState]['error']) or waitTime > ERROR_TIME:
                 break
         return nextState
@@ -115,6 +113,7 @@ class StateMachine:
             if newState.upper() in self.endStates:
                 print("Recovery ended on {0}".format(newState.upper()))
                 handler(records)
+                records['Output'].wait()
                 break
             else:
                 print("Recovery in {0} state".format(newState.upper()))
@@ -145,20 +144,16 @@ def no_fault_actions(recs):
     print('Non Zero Speed Fault not present, ending sequence')
 
 def follow_off_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['tcsMCSFollow'].put('Off')
     out['tcsApply'].put(3)
-    startTime = datetime.now()
-    while True:
-        if not(inp['mcsFollow'].value):
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: Unable to disable MCS Tracking')
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: not(inp['mcsFollow'].value),
+                      [inp['mcsFollow']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: Unable to disable MCS Tracking')
+        newState = 'rec_error'
+        return (newState, recs)
     if inp['prevState'] == 'follow_on':
         newState = 'follow_on'
     elif (abs(inp['voltAz'].value) > 0.5) or (abs(inp['voltEl'].value) > 0.5):
@@ -168,42 +163,37 @@ def follow_off_state(recs):
     return (newState, recs)
 
 def voltage_zero_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['f1Reset'].put(1)
     # out['eStop'].put(1)
-    time.sleep(0.2)
+    # Wait for the reset to be processed
+    out.wait()
     # out['eStop'].put(0)
-    startTime = datetime.now()
-    while True:
-        if (abs(inp['voltAz'].value) < 0.1) and (abs(inp['voltEl'].value) < 0.1):
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: Unable to zero reference voltage')
-            print('Az Volts: {0} - El Volts: {1}'.format(inp['voltAz'].value,
-                                                        inp['voltEl'].value))
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: ((abs(inp['voltAz'].value) < 0.1)
+                               and (abs(inp['voltEl'].value) < 0.1)),
+                      [inp['voltAz'], inp['voltEl']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: Unable to zero reference voltage')
+        print('Az Volts: {0} - El Volts: {1}'.format(inp['voltAz'].value,
+                                                    inp['voltEl'].value))
+        newState = 'rec_error'
+        return (newState, recs)
     newState = 'clear_nzsf'
-    time.sleep(1)
+    CLOCK.sleep(1)
     return (newState, recs)
 
 def clear_nzsf_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['f1Reset'].put(1)
-    startTime = datetime.now()
-    while True:
-        if (not(inp['nzsAz'].value) and not(inp['nzsEl'].value)):
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: Unable to clear Non Zero Speed Fault from GIS')
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: (not(inp['nzsAz'].value)
+                               and not(inp['nzsEl'].value)),
+                      [inp['nzsAz'], inp['nzsEl']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: Unable to clear Non Zero Speed Fault from GIS')
+        newState = 'rec_error'
+        return (newState, recs)
     newState = 'fault_cleared'
     return (newState, recs)
 
@@ -218,36 +208,28 @@ def fault_cleared_state(recs):
     return (newState, recs)
 
 def az_disassert_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['azDriveEn'].put(1)
-    startTime = datetime.now()
-    while True:
-        if inp['azDriveCond'].value == 1:
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: Azimuth Drive did not disassert')
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: inp['azDriveCond'].value == 1,
+                      [inp['azDriveCond']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: Azimuth Drive did not disassert')
+        newState = 'rec_error'
+        return (newState, recs)
     newState = 'el_disassert'
     return (newState, recs)
 
 def el_disassert_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['elDriveEn'].put(1)
-    startTime = datetime.now()
-    while True:
-        if inp['elDriveCond'].value == 1:
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: Elevation Drive did not disassert')
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: inp['elDriveCond'].value == 1,
+                      [inp['elDriveCond']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: Elevation Drive did not disassert')
+        newState = 'rec_error'
+        return (newState, recs)
     newState = 'disable_tracking'
     return (newState, recs)
 
@@ -258,19 +240,15 @@ def disable_tracking_state(recs):
     return (newState, recs)
 
 def az_assert_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['azDriveEn'].put(2)
-    startTime = datetime.now()
-    while True:
-        if inp['azDriveCond'].value == 2:
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: Azimuth Drive did not assert')
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: inp['azDriveCond'].value == 2,
+                      [inp['azDriveCond']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: Azimuth Drive did not assert')
+        newState = 'rec_error'
+        return (newState, recs)
     newState = 'enable_tracking'
     return (newState, recs)
 
@@ -281,37 +259,29 @@ def enable_tracking_state(recs):
     return (newState, recs)
 
 def el_assert_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['elDriveEn'].put(2)
-    startTime = datetime.now()
-    while True:
-        if inp['elDriveCond'].value == 2:
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: Elevation Drive did not assert')
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: inp['elDriveCond'].value == 2,
+                      [inp['elDriveCond']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: Elevation Drive did not assert')
+        newState = 'rec_error'
+        return (newState, recs)
     newState = 'follow_on'
     return (newState, recs)
 
 def follow_on_state(recs):
-    waitTime = 0
     inp = recs['Input']
     out = recs['Output']
     out['tcsMCSFollow'].put('On')
     out['tcsApply'].put(3)
-    startTime = datetime.now()
-    while True:
-        if inp['mcsFollow'].value:
-            break
-        elif waitTime > ERROR_TIME:
-            print('Error: MCS did not start tracking')
-            newState = 'rec_error'
-            return (newState, recs)
-        waitTime = (datetime.now() - startTime).total_seconds()
+    if not(wait_until(lambda: inp['mcsFollow'].value,
+                      [inp['mcsFollow']], ERROR_TIME,
+                      WAIT_STRATEGY, CLOCK)):
+        print('Error: MCS did not start tracking')
+        newState = 'rec_error'
+        return (newState, recs)
     if (((abs(inp['voltAz'].value) < 0.1)
          and (abs(inp['azPosErr'].value) > 0.01))
         or ((abs(inp['voltEl'].value) < 0.1)
@@ -1,55 +1,75 @@
 #!/usr/bin/env python3.5
 
-import os
-import argparse
-import epics
-import time
-import h5py
-import re
-import numpy as np
+import sys
 import collections
 
-from datetime import datetime, timedelta
-from StateMachineLib import StateMachine, State
+from StateMachineLib import StateMachine, State, PVPool, OutputQueue
+from StateMachineLib import InputFilter, InitializationError, log_message
 
 ERROR_TIME = 1.5*60
-Recs = {}
-inputs = {}
-outputs = {}
+# Time allowed to the drives to assert/disassert and to MCS to change follow
+# mode, and to the whole recovery
+DRIVE_TIME = 10.0
+FOLLOW_TIME = 30.0
+SEQUENCE_TIME = 3*60
+# Filters of the noisy analog inputs. Deadbands are an order of magnitude
+# below the thresholds the conditions compare them with
+VOLT_DEADBAND = 0.01
+POS_ERR_DEADBAND = 0.001
+ANALOG_INTERVAL = 0.1
+# Inputs that start a recovery in daemon mode, and seconds the fault has to
+# hold before it does
+TRIGGERS = ('nzsAz', 'nzsEl')
+DEBOUNCE_TIME = 0.5
+inputPVs = collections.OrderedDict()
+outputPVs = collections.OrderedDict()
 
 # Conditions for transitions of the State Machine
 # Az and EL non zero speed fault
-inputs['nzsAz'] = epics.PV('gis:az:azns:aznssums.VAL')
-inputs['nzsEl'] = epics.PV('gis:alt:altns:altnssums.VAL')
+inputPVs['nzsAz'] = 'gis:az:azns:aznssums.VAL'
+inputPVs['nzsEl'] = 'gis:alt:altns:altnssums.VAL'
 # Voltage set-point for Az and El motors
-inputs['voltAz'] = epics.PV('gis:mon:azmon3:azdspdspc.VAL')
-inputs['voltEl'] = epics.PV('gis:mon:altmon3:altdspdspc.VAL')
+inputPVs['voltAz'] = InputFilter('gis:mon:azmon3:azdspdspc.VAL',
+                                 VOLT_DEADBAND, ANALOG_INTERVAL)
+inputPVs['voltEl'] = InputFilter('gis:mon:altmon3:altdspdspc.VAL',
+                                 VOLT_DEADBAND, ANALOG_INTERVAL)
 # MCS follow mode state
-inputs['mcsFollow'] = epics.PV('mc:FollowL')
+inputPVs['mcsFollow'] = 'mc:FollowL'
 # Az and El drives assert state
-inputs['azDriveCond'] = epics.PV('mc:azDriveCondition')
-inputs['elDriveCond'] = epics.PV('mc:elDriveCondition')
-inputs['azPosErr'] = epics.PV('mc:azPosError')
-inputs['elPosErr'] = epics.PV('mc:elPosError')
-inputs['prevState'] = ''
+inputPVs['azDriveCond'] = 'mc:azDriveCondition'
+inputPVs['elDriveCond'] = 'mc:elDriveCondition'
+inputPVs['azPosErr'] = InputFilter('mc:azPosError', POS_ERR_DEADBAND,
+                                   ANALOG_INTERVAL)
+inputPVs['elPosErr'] = InputFilter('mc:elPosError', POS_ERR_DEADBAND,
+                                   ANALOG_INTERVAL)
 
 # Actions taken by each state of the State Machine
 # TCS Follow directive
-outputs['tcsMCSFollow'] = epics.PV('tcs:mcFollow.A')
+outputPVs['tcsMCSFollow'] = 'tcs:mcFollow.A'
 # TCS Apply directives
-outputs['tcsApply'] = epics.PV('tcs:apply.DIR')
+outputPVs['tcsApply'] = 'tcs:apply.DIR'
 # F1 Reset
-outputs['f1Reset'] = epics.PV('gis:tsrs:gisReset.PROC')
+outputPVs['f1Reset'] = 'gis:tsrs:gisReset.PROC'
 # MCS E-stop for motors
-outputs['eStop'] = epics.PV('mc:azEstop.PROC')
+outputPVs['eStop'] = 'mc:azEstop.PROC'
 # Disable MCS ability to go into Follow Mode
-outputs['mcsTrackDis'] = epics.PV('mc:followTrackingOn.DISA')
+outputPVs['mcsTrackDis'] = 'mc:followTrackingOn.DISA'
 # Assert/Disassert Az and El drives
-outputs['azDriveEn'] = epics.PV('mc:azDriveEnable')
-outputs['elDriveEn'] = epics.PV('mc:elDriveEnable')
-
-Recs['Input'] = inputs
-Recs['Output'] = outputs
+outputPVs['azDriveEn'] = 'mc:azDriveEnable'
+outputPVs['elDriveEn'] = 'mc:elDriveEnable'
+
+def make_records(pool=None, clock=None):
+    '''
+    Builds the input/output dictionary used by the State Machine. PVs are
+    taken from pool, so several recoveries running under one Supervisor
+    share the same channels. Outputs are wrapped in an OutputQueue, so puts
+    don't block the handlers; clock is only needed for simulated time.
+    '''
+    if pool is None:
+        pool = PVPool()
+    recs = pool.make_records(inputPVs, outputPVs)
+    recs['Output'] = OutputQueue(recs['Output'], clock)
+    return recs
 
 states = \
     [['start', 'SS'],
@@ -69,25 +89,24 @@ states = \
      ['rec_error', 'ES']]
 
 def start_handler(recs):
-    print('Initiating Non Zero Speed Fault Recovery')
+    log_message(recs, 'Initiating Non Zero Speed Fault Recovery')
 
 start_trans = \
-    [['no_fault', ['nzsAz','nzsEl'],
-      lambda n,i: not(i[n[0]].value) and not(i[n[1]].value),
+    [['no_fault', [],
+      'not nzsAz and not nzsEl',
       False, ''],
-     ['follow_off', ['mcsFollow'],
-      lambda n,i: i[n[0]].value,
+     ['follow_off', [],
+      'mcsFollow',
       False, ''],
-     ['voltage_zero', ['voltAz','voltEl'],
-      lambda n,i: ((abs(i[n[0]].value) > 0.5)
-                   or (abs(i[n[1]]).value > 0.5)),
+     ['voltage_zero', [],
+      'abs(voltAz) > 0.5 or abs(voltEl) > 0.5',
       False, ''],
-     ['clear_nzsf', [''],
-      lambda n,i: True,
+     ['clear_nzsf', [],
+      'True',
       False, '']]
 
 def no_fault_handler(recs):
-    print('Non Zero Speed Fault not present, ending sequence')
+    log_message(recs, 'Non Zero Speed Fault not present, ending sequence')
 
 no_fault_trans = []
 
@@ -98,18 +117,17 @@ def follow_off_handler(recs):
     out['tcsApply'].put(3)
 
 follow_off_trans = \
-    [['rec_error', ['mcsFollow'],
-      lambda n,i: i[n[0]].value,
-      True, 'Error: Could not disable MCS Tracking'],
-     ['follow_on', ['prevState'],
-      lambda n,i: i[n[0]] == 'follow_on',
+    [['rec_error', [],
+      'mcsFollow',
+      True, 'Error: Could not disable MCS Tracking', FOLLOW_TIME],
+     ['follow_on', [],
+      "prevState == 'follow_on'",
       False, ''],
-     ['voltage_zero', ['voltAz','voltEl'],
-      lambda n,i: ((abs(i[n[0]].value) > 0.5)
-                   or (abs(i[n[1]]).value > 0.5)),
+     ['voltage_zero', [],
+      'abs(voltAz) > 0.5 or abs(voltEl) > 0.5',
       False, ''],
-     ['clear_nzsf', [''],
-      lambda n,i: True,
+     ['clear_nzsf', [],
+      'True',
       False, '']]
 
 def voltage_zero_handler(recs):
@@ -117,16 +135,16 @@ def voltage_zero_handler(recs):
     out = recs['Output']
     out['f1Reset'].put(1)
     # out['eStop'].put(1)
-    time.sleep(0.2)
+    # Wait for the reset to be processed
+    out.wait()
     # out['eStop'].put(0)
 
 voltage_zero_trans = \
-    [['rec_error', ['voltAz','voltEl'],
-      lambda n,i: ((abs(i[n[0]].value) > 0.1)
-                   or (abs(i[n[1]]).value > 0.1)),
+    [['rec_error', [],
+      'abs(voltAz) > 0.1 or abs(voltEl) > 0.1',
       True, 'Error: Unable to zero reference voltage'],
-     ['clear_nzsf', [''],
-      lambda n,i: True,
+     ['clear_nzsf', [],
+      'True',
       False, '']]
 
 def clear_nzsf_handler(recs):
@@ -135,25 +153,25 @@ def clear_nzsf_handler(recs):
     out['f1Reset'].put(1)
 
 clear_nzsf_trans = \
-    [['rec_error', ['nzsAz','nzsEl'],
-      lambda n,i: i[n[0]].value or i[n[1]].value,
+    [['rec_error', [],
+      'nzsAz or nzsEl',
       True, 'Error: Unable to clear Non Zero Speed Fault from GIS'],
-     ['fault_cleared', [''],
-      lambda n,i: True,
+     ['fault_cleared', [],
+      'True',
       False, '']]
 
 def fault_cleared_handler(recs):
     pass
 
 fault_cleared_trans = \
-    [['az_disassert', ['azDriveCond'],
-      lambda n,i: i[n[0]].value == 2,
+    [['az_disassert', [],
+      'azDriveCond == 2',
       False, ''],
-     ['el_disassert', ['elDriveCond'],
-      lambda n,i: i[n[0]].value == 2,
+     ['el_disassert', [],
+      'elDriveCond == 2',
       False, ''],
-     ['disable_tracking', [''],
-      lambda n,i: True,
+     ['disable_tracking', [],
+      'True',
       False, '']]
 
 def az_disassert_handler(recs):
@@ -162,11 +180,11 @@ def az_disassert_handler(recs):
     out['azDriveEn'].put(1)
 
 az_disassert_trans = \
-    [['rec_error', ['azDriveCond'],
-      lambda n,i: i[n[0]].value != 1,
-      True, 'Error: Azimuth Drive did not disassert'],
-     ['el_disassert', [''],
-      lambda n,i: True,
+    [['rec_error', [],
+      'azDriveCond != 1',
+      True, 'Error: Azimuth Drive did not disassert', DRIVE_TIME],
+     ['el_disassert', [],
+      'True',
       False, '']]
 
 def el_disassert_handler(recs):
@@ -175,11 +193,11 @@ def el_disassert_handler(recs):
     out['elDriveEn'].put(1)
 
 el_disassert_trans = \
-    [['rec_error', ['elDriveCond'],
-      lambda n,i: i[n[0]].value != 1,
-      True, 'Error: Elevation Drive did not disassert'],
-     ['disable_tracking', [''],
-      lambda n,i: True,
+    [['rec_error', [],
+      'elDriveCond != 1',
+      True, 'Error: Elevation Drive did not disassert', DRIVE_TIME],
+     ['disable_tracking', [],
+      'True',
       False, '']]
 
 def disable_tracking_handler(recs):
@@ -187,8 +205,8 @@ def disable_tracking_handler(recs):
     out['mcsTrackDis'].put(1)
 
 disable_tracking_trans = \
-    [['az_assert', [''],
-      lambda n,i: True,
+    [['az_assert', [],
+      'True',
       False, '']]
 
 def az_assert_handler(recs):
@@ -197,11 +215,11 @@ def az_assert_handler(recs):
     out['azDriveEn'].put(2)
 
 az_assert_trans = \
-    [['rec_error', ['azDriveCond'],
-      lambda n,i: i[n[0]].value != 2,
-      True, 'Error: Azimuth Drive did not assert'],
-     ['enable_tracking', [''],
-      lambda n,i: True,
+    [['rec_error', [],
+      'azDriveCond != 2',
+      True, 'Error: Azimuth Drive did not assert', DRIVE_TIME],
+     ['enable_tracking', [],
+      'True',
       False, '']]
 
 def enable_tracking_handler(recs):
@@ -209,8 +227,8 @@ def enable_tracking_handler(recs):
     out['mcsTrackDis'].put(0)
 
 enable_tracking_trans = \
-    [['el_assert', [''],
-      lambda n,i: True,
+    [['el_assert', [],
+      'True',
       False, '']]
 
 def el_assert_handler(recs):
@@ -219,11 +237,11 @@ def el_assert_handler(recs):
     out['elDriveEn'].put(2)
 
 el_assert_trans = \
-    [['rec_error', ['elDriveCond'],
-      lambda n,i: i[n[0]].value != 2,
-      True, 'Error: Elevation Drive did not assert'],
-     ['follow_on', [''],
-      lambda n,i: True,
+    [['rec_error', [],
+      'elDriveCond != 2',
+      True, 'Error: Elevation Drive did not assert', DRIVE_TIME],
+     ['follow_on', [],
+      'True',
       False, '']]
 
 def follow_on_handler(recs):
@@ -233,36 +251,42 @@ def follow_on_handler(recs):
     out['tcsApply'].put(3)
 
 follow_on_trans = \
-    [['rec_error', ['mcsFollow'],
-      lambda n,i: not(i[n[0]].value),
-      True, 'Error: Could not disable MCS Tracking'],
-     ['rec_success', ['voltAz','azPosErr','voltEl','elPosErr'],
-      lambda n,i: ((((abs(i[n[0]].value) > 0.1) and (abs(i[n[2]]).value > 0.01))
-                    or ((abs(i[n[0]].value) > 0.1) and (abs(i[n[2]]).value > 0.01)))
-                   or ((abs(i[n[2]]).value < 0.01) and (abs(i[n[3]].value) < 0.01))),
+    [['rec_error', [],
+      'not mcsFollow',
+      True, 'Error: Could not disable MCS Tracking', FOLLOW_TIME],
+     ['rec_success', [],
+      # Tracking unless a drive has no voltage while it has position error
+      ('not ((abs(voltAz) < 0.1 and abs(azPosErr) > 0.01)'
+       ' or (abs(voltEl) < 0.1 and abs(elPosErr) > 0.01))'),
       False, ''],
-     ['rec_error', ['prevState'],
-      lambda n,i: i[n[0]].value == 'follow_off',
+     ['rec_error', [],
+      "prevState == 'follow_off'",
       True, 'MCS Follow enabled but telescope not tracking'],
-     ['follow_off', [''],
-      lambda n,i: True,
+     ['follow_off', [],
+      'True',
       False, 'Resetting MCS Follow mode']]
 
 def rec_success_handler(recs):
-    print('Non Zero Speed Fault recovery successful')
+    log_message(recs, 'Non Zero Speed Fault recovery successful')
 
 rec_success_trans = []
 
 def rec_error_handler(recs):
     out = recs['Output']
     out['mcsTrackDis'].put(0)
-    print('Non Zero Speed Fault recovery ended in error')
+    log_message(recs, 'Non Zero Speed Fault recovery ended in error')
 
 rec_error_trans = []
 
-if __name__ == '__main__':
-    nzsfSM = StateMachine()
-    state_array = []
+def build_state_machine(clock=None, log=None):
+    '''
+    Builds the recovery State Machine from the states list and the
+    STATE_handler and STATE_trans definitions of this module. The machine
+    only holds the definition, so it is built once and every recovery is a
+    new run of it: nzsfSM.run_sequence(recs).
+    '''
+    module = sys.modules[__name__]
+    nzsfSM = StateMachine(clock=clock, timeout=SEQUENCE_TIME, log=log)
     for sn in states:
         es = False
         ss = False
@@ -273,15 +297,51 @@ if __name__ == '__main__':
         if 'ES' in sn:
             es = True
             n = sn[0]
-        s = State(n,eval(n+'_handler'),eval(n+'_trans'),ss,es)
-        print('State {} ready'.format(s.name))
+        s = State(n, getattr(module, n + '_handler'),
+                  getattr(module, n + '_trans'), ss, es)
+        nzsfSM.log.emit('state_ready', 'State {} ready'.format(s.name),
+                        state=s.name)
         s.init_transitions()
-        # state_array.append(s)
         nzsfSM.add_state(s)
-    nzsfSM.run(Recs)
-
-
-
-
-
+    return nzsfSM
 
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Non Zero Speed Fault recovery')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Stay resident and start a recovery on every '
+                        'fault of {}'.format(' or '.join(TRIGGERS)))
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE_TIME,
+                        help='Seconds a fault has to hold in daemon mode')
+    parser.add_argument('--max-runs', type=int, default=1,
+                        help='Recoveries running at the same time in daemon '
+                        'mode')
+    parser.add_argument('--run-handlers', action='store_true',
+                        help='Run the state handlers, which take the '
+                        'corrective actions. Without it the recovery is a '
+                        'dry run that only follows the transitions')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='Save the progress of every recovery to FILE '
+                        'and resume the ones that were interrupted, if any')
+    args = parser.parse_args()
+    nzsfSM = build_state_machine()
+    nzsfSM.runHandlers = args.run_handlers
+    if args.checkpoint:
+        from SMCheckpoint import Checkpoint
+        nzsfSM.checkpoint = Checkpoint(args.checkpoint)
+    if args.daemon:
+        from SMDaemon import Daemon
+        daemon = Daemon(nzsfSM, make_records(), TRIGGERS, args.debounce,
+                        args.max_runs)
+        try:
+            daemon.serve_forever()
+        except InitializationError as err:
+            nzsfSM.log.emit('error', err.message)
+            exit(0)
+    else:
+        recs = make_records()
+        run = None
+        if nzsfSM.checkpoint is not None:
+            run = nzsfSM.checkpoint.resume(nzsfSM, recs)
+        nzsfSM.run(recs, run=run)
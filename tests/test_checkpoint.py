@@ -0,0 +1,221 @@
+#!/usr/bin/env python3.5
+'''
+Tests of the checkpoint file of SMCheckpoint: recovery from torn and corrupt
+records, the checks that make a checkpoint stale, the rollback to a safe
+state and the resume of interrupted and already resumed runs.
+Run with python3 -m pytest tests or python3 -m unittest discover tests
+'''
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import nzsfRecovery
+from StateMachineLib import StateMachine, State
+from SMEventLog import EventLog
+from SMSim import SimBackend
+from SMCheckpoint import Checkpoint, RECORD
+
+# A path through the nzsf table
+PATH = ['start', 'follow_off', 'voltage_zero', 'clear_nzsf', 'fault_cleared',
+        'az_disassert']
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'nzsf.ckpt')
+        self.sm = nzsfRecovery.build_state_machine(log=EventLog([]))
+        self.recs = nzsfRecovery.make_records(SimBackend())
+        self.sm.compile()
+        self.checkpoints = []
+
+    def tearDown(self):
+        for c in self.checkpoints:
+            c.close()
+        self.tmp.cleanup()
+
+    def open(self, **kw):
+        checkpoint = Checkpoint(self.path, **kw)
+        self.checkpoints.append(checkpoint)
+        return checkpoint
+
+    def ids(self, names):
+        return [self.sm.states[n.upper()].id for n in names]
+
+    def walk(self, checkpoint, names, run=None, end=False):
+        # Saves a run that goes through the given states, as the State
+        # Machine does, and returns it
+        sm = self.sm
+        if run is None:
+            run = sm.new_run(self.recs, 60)
+            names = names[1:]
+        checkpoint.save(sm, run)
+        for k, n in enumerate(names):
+            run.enter(sm.states[n.upper()].id, sm.clock.now())
+            checkpoint.save(sm, run, end and k == len(names) - 1)
+        return run
+
+    def test_resume(self):
+        checkpoint = self.open()
+        crashed = self.walk(checkpoint, PATH)
+        run = checkpoint.resume(self.sm, self.recs)
+        self.assertNotEqual(run.runId, crashed.runId)
+        self.assertEqual(run.resumedFrom, crashed.runId)
+        self.assertEqual(run.history, self.ids(PATH))
+        self.assertEqual(run.state, self.ids(PATH)[-1])
+        self.assertEqual(run.steps, len(PATH) - 1)
+        self.assertEqual(run.records['Input']['prevState'], PATH[-2])
+        self.assertLess(run.deadline - self.sm.clock.now(), 60)
+
+    def test_ended(self):
+        checkpoint = self.open()
+        self.walk(checkpoint, PATH + ['rec_success'], end=True)
+        self.assertIsNone(checkpoint.resume(self.sm, self.recs))
+
+    def test_torn_tail(self):
+        checkpoint = self.open()
+        self.walk(checkpoint, PATH[:3])
+        checkpoint.close()
+        self.checkpoints.remove(checkpoint)
+        # A crash in the middle of a write
+        with open(self.path, 'ab') as f:
+            f.write(b'SMCP' + bytes(RECORD.size//2))
+        checkpoint = self.open()
+        self.assertEqual(os.path.getsize(self.path), 3*RECORD.size)
+        self.assertEqual(len(checkpoint.records()), 3)
+        # Records appended afterwards stay aligned
+        self.walk(checkpoint, PATH)
+        self.assertEqual(len(checkpoint.records()), 3 + len(PATH))
+        run = checkpoint.resume(self.sm, self.recs)
+        self.assertEqual(run.history, self.ids(PATH))
+
+    def test_bad_crc(self):
+        checkpoint = self.open()
+        self.walk(checkpoint, PATH)
+        # Corrupts the state of the last record
+        with open(self.path, 'r+b') as f:
+            f.seek((len(PATH) - 1)*RECORD.size + 72)
+            f.write(b'\xff')
+        records = checkpoint.records()
+        self.assertEqual(len(records), len(PATH) - 1)
+        run = checkpoint.resume(self.sm, self.recs)
+        self.assertEqual(run.history, self.ids(PATH[:-1]))
+
+    def test_fingerprint(self):
+        checkpoint = self.open()
+        self.walk(checkpoint, PATH)
+        # Same file, different State Machine
+        other = StateMachine(log=EventLog([]))
+        for name, targets, ss, es in (('start', ['end'], True, False),
+                                      ('end', [], False, True)):
+            s = State(name, None, [[t, [], 'True', False, '']
+                                   for t in targets], ss, es)
+            s.init_transitions()
+            other.add_state(s)
+        self.assertIsNone(checkpoint.resume(other, self.recs))
+        self.assertIsNotNone(checkpoint.resume(self.sm, self.recs))
+
+    def test_max_age(self):
+        checkpoint = self.open(maxAge=0.01)
+        self.walk(checkpoint, PATH)
+        time.sleep(0.02)
+        self.assertIsNone(checkpoint.resume(self.sm, self.recs))
+        checkpoint.maxAge = 60
+        self.assertIsNotNone(checkpoint.resume(self.sm, self.recs))
+
+    def test_safe_rollback(self):
+        checkpoint = self.open(safe=['follow_off', 'clear_nzsf'])
+        self.walk(checkpoint, PATH)
+        run = checkpoint.resume(self.sm, self.recs)
+        # The last safe state of PATH is clear_nzsf
+        self.assertEqual(run.history, self.ids(PATH[:4]))
+        self.assertEqual(run.state, self.ids(['clear_nzsf'])[0])
+        self.assertEqual(run.steps, 3)
+        self.assertEqual(run.records['Input']['prevState'], 'voltage_zero')
+        # No safe state in the history
+        checkpoint.safe = {'REC_ERROR'}
+        self.assertIsNone(checkpoint.resume(self.sm, self.recs))
+
+    def test_resume_resumed(self):
+        checkpoint = self.open()
+        first = self.walk(checkpoint, PATH[:4])
+        second = checkpoint.resume(self.sm, self.recs)
+        # The resumed run takes one more step and is interrupted again
+        self.walk(checkpoint, PATH[4:5], second)
+        third = checkpoint.resume(self.sm, self.recs)
+        self.assertEqual(third.resumedFrom, second.runId)
+        self.assertEqual(third.history, self.ids(PATH[:5]))
+        self.assertEqual(third.steps, 4)
+        # Only the last run of the chain is interrupted
+        self.assertEqual([r.resumedFrom for r in
+                          checkpoint.resume_all(self.sm, self.recs)],
+                         [second.runId])
+        self.assertNotIn(first.runId,
+                         [r.resumedFrom for r in
+                          checkpoint.resume_all(self.sm, self.recs)])
+        # Once it ends there is nothing to resume
+        self.walk(checkpoint, ['rec_success'], third, end=True)
+        self.assertIsNone(checkpoint.resume(self.sm, self.recs))
+
+    def test_concurrent_runs(self):
+        checkpoint = self.open()
+        sm = self.sm
+        a = sm.new_run(self.recs)
+        b = sm.new_run(self.recs)
+        checkpoint.save(sm, a)
+        checkpoint.save(sm, b)
+        # Interleaved records of two runs, neither of them ends
+        for n in PATH[1:]:
+            for run in (a, b):
+                run.enter(sm.states[n.upper()].id, sm.clock.now())
+                checkpoint.save(sm, run)
+        c = self.walk(checkpoint, PATH[:3])
+        runs = checkpoint.resume_all(sm, self.recs)
+        self.assertEqual([r.resumedFrom for r in runs],
+                         [a.runId, b.runId, c.runId])
+        self.assertEqual([r.history for r in runs],
+                         [self.ids(PATH), self.ids(PATH),
+                          self.ids(PATH[:3])])
+        self.assertEqual(checkpoint.resume(sm, self.recs).resumedFrom,
+                         c.runId)
+
+    def test_compact(self):
+        checkpoint = self.open(maxBytes=10*RECORD.size)
+        interrupted = self.walk(checkpoint, PATH)
+        for i in range(5):
+            self.walk(checkpoint, PATH + ['rec_success'], end=True)
+        # Only the interrupted run, still live for this process, is kept
+        self.assertLess(os.path.getsize(self.path), 20*RECORD.size)
+        runs = checkpoint.runs()
+        self.assertIn(interrupted.runId, runs)
+        run = checkpoint.resume(self.sm, self.recs)
+        self.assertEqual(run.resumedFrom, interrupted.runId)
+        self.assertEqual(run.history, self.ids(PATH))
+
+    def test_compact_resumed(self):
+        checkpoint = self.open()
+        first = self.walk(checkpoint, PATH[:4])
+        checkpoint.close()
+        self.checkpoints.remove(checkpoint)
+        # After a restart only the resumed run is live, but the history it
+        # continues is in the records of the run it resumed
+        checkpoint = self.open(maxBytes=10*RECORD.size)
+        second = checkpoint.resume(self.sm, self.recs)
+        self.walk(checkpoint, PATH[4:5], second)
+        for i in range(5):
+            self.walk(checkpoint, PATH + ['rec_success'], end=True)
+        self.assertLess(os.path.getsize(self.path), 20*RECORD.size)
+        runs = checkpoint.runs()
+        self.assertIn(first.runId, runs)
+        self.assertIn(second.runId, runs)
+        run = checkpoint.resume(self.sm, self.recs)
+        self.assertEqual(run.resumedFrom, second.runId)
+        self.assertEqual(run.history, self.ids(PATH[:5]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3.5
+'''
+Tests of the condition language of SMCondition: what parse accepts, what it
+rejects, and that the vectorized evaluation of a Condition agrees with its
+evaluation on one snapshot.
+Run with python3 -m pytest tests or python3 -m unittest discover tests
+'''
+
+import os
+import sys
+import random
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from StateMachineLib import InitializationError, Sample
+from SMCondition import parse, snapshot_columns
+
+# Conditions of the language, with a snapshot and the value expected on it
+ACCEPTED = [
+    ('0 < voltAz < 1', {'voltAz':0.5}, True),
+    ('0 < voltAz < 1', {'voltAz':1.5}, False),
+    ('-1 <= voltAz <= 1 != voltEl', {'voltAz':1.0, 'voltEl':2.0}, True),
+    ('-1 <= voltAz <= 1 != voltEl', {'voltAz':1.0, 'voltEl':1.0}, False),
+    ('abs(voltAz) > 0.5', {'voltAz':-0.7}, True),
+    ('abs(voltAz) > 0.5', {'voltAz':0.3}, False),
+    ('voltAz > -0.5', {'voltAz':-0.2}, True),
+    ('voltAz > -0.5', {'voltAz':-0.8}, False),
+    ("prevState == 'follow_off'", {'prevState':'follow_off'}, True),
+    ("prevState == 'follow_off'", {'prevState':'start'}, False),
+    ('not nzsAz and not nzsEl', {'nzsAz':0, 'nzsEl':0}, True),
+    ('not nzsAz and not nzsEl', {'nzsAz':0, 'nzsEl':1}, False),
+    ('nzsAz or nzsEl', {'nzsAz':0, 'nzsEl':1}, True),
+    ('not (nzsAz or nzsEl)', {'nzsAz':0, 'nzsEl':1}, False),
+    ('True', {}, True),
+    ('False', {}, False),
+]
+
+# Conditions outside the language
+REJECTED = [
+    'len(prevState) > 0',
+    'abs(voltAz, voltEl) > 0',
+    'abs(x=voltAz) > 0',
+    '__import__("os").system("true")',
+    'voltAz.value > 0',
+    'prevState.upper() == "START"',
+    "prevState in ('start', 'follow_off')",
+    'voltAz not in (0, 1)',
+    'voltAz is None',
+    'voltAz + 1 > 0',
+    'voltAz * 2 > 1',
+    '-voltAz > 0',
+    'voltAz[0] > 0',
+    'lambda: voltAz',
+    'voltAz if nzsAz else voltEl',
+    '(0, 1)',
+    'voltAz >',
+    '',
+]
+
+class TestParse(unittest.TestCase):
+    def test_accepted(self):
+        for text, snap, expected in ACCEPTED:
+            with self.subTest(text=text, snap=snap):
+                cond = parse(text)
+                self.assertEqual(bool(cond.test(snap)), expected)
+                self.assertEqual(cond.inputs, sorted(snap))
+
+    def test_samples(self):
+        # Inputs are read from the value of PVs and Samples
+        cond = parse('abs(voltAz) > 0.5 or abs(voltEl) > 0.5')
+        self.assertTrue(cond.test({'voltAz':Sample(0.0),
+                                   'voltEl':Sample(-0.6)}))
+        self.assertFalse(cond.test({'voltAz':Sample(0.0),
+                                    'voltEl':Sample(0.4)}))
+
+    def test_rejected(self):
+        for text in REJECTED:
+            with self.subTest(text=text):
+                with self.assertRaises(InitializationError):
+                    parse(text)
+
+    def test_error_message(self):
+        with self.assertRaises(InitializationError) as ctx:
+            parse('voltAz.value > 0')
+        self.assertIn('voltAz.value > 0', ctx.exception.message)
+
+class TestVector(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+
+    def random_snapshot(self, rnd, names):
+        snap = {}
+        for n in names:
+            if n == 'prevState':
+                snap[n] = rnd.choice(['start', 'follow_off', 'follow_on'])
+            else:
+                snap[n] = rnd.choice([-1.5, -1.0, -0.5, 0.0, 0.5, 1.0, 1.5,
+                                      rnd.uniform(-2, 2)])
+        return snap
+
+    def test_vector_matches_test(self):
+        rnd = random.Random(12345)
+        for text, snap, expected in ACCEPTED:
+            cond = parse(text)
+            snapshots = [self.random_snapshot(rnd, cond.inputs)
+                         for i in range(200)]
+            cols = snapshot_columns(snapshots, cond.inputs)
+            vector = cond.vector(cols, len(snapshots))
+            with self.subTest(text=text):
+                self.assertEqual(len(vector), len(snapshots))
+                self.assertEqual([bool(v) for v in vector],
+                                 [bool(cond.test(s)) for s in snapshots])
+
+if __name__ == '__main__':
+    unittest.main()
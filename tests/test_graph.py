@@ -0,0 +1,140 @@
+#!/usr/bin/env python3.5
+'''
+Tests of the static analysis of SMGraph: the cycles found by StateGraph and
+the errors reported by check.
+Run with python3 -m pytest tests or python3 -m unittest discover tests
+'''
+
+import os
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import nzsfRecovery
+from StateMachineLib import StateMachine, State, InitializationError
+from SMEventLog import EventLog
+from SMGraph import StateGraph
+
+def build(table, start=None, ends=()):
+    '''
+    Returns the StateGraph of a State Machine built from a list of
+    (state name, target names). The first state is the Start State unless
+    start is given
+    '''
+    sm = StateMachine(log=EventLog([]))
+    start = start or table[0][0]
+    for name, targets in table:
+        s = State(name, None,
+                  [[t, [], 'True', False, ''] for t in targets],
+                  name == start, name in ends)
+        s.init_transitions()
+        sm.add_state(s)
+    return StateGraph(sm)
+
+class TestCycles(unittest.TestCase):
+    def test_acyclic(self):
+        graph = build([('a', ['b', 'c']), ('b', ['c']), ('c', [])],
+                      ends=('c',))
+        self.assertEqual(graph.cycles(), [])
+
+    def test_self_loop(self):
+        graph = build([('a', ['a', 'b']), ('b', [])], ends=('b',))
+        self.assertEqual(graph.cycles(), [[0]])
+        self.assertEqual(graph.analyze()['cycles'], [['a']])
+
+    def test_nested(self):
+        # a <-> b and c <-> d are cycles of their own, and a -> b -> c -> a
+        # joins them in one component with e, which loops on itself inside
+        # it; f -> g -> f is a separate component after it
+        graph = build([('a', ['b']),
+                       ('b', ['a', 'c']),
+                       ('c', ['d', 'a']),
+                       ('d', ['c', 'e']),
+                       ('e', ['e', 'b', 'f']),
+                       ('f', ['g']),
+                       ('g', ['f', 'end']),
+                       ('end', [])], ends=('end',))
+        self.assertEqual(sorted(graph.cycles()), [[0, 1, 2, 3, 4], [5, 6]])
+
+    def test_sequential(self):
+        # Components one after the other
+        graph = build([('a', ['b']), ('b', ['a', 'c']),
+                       ('c', ['d']), ('d', ['c', 'end']),
+                       ('end', [])], ends=('end',))
+        self.assertEqual(sorted(graph.cycles()), [[0, 1], [2, 3]])
+
+    def test_deep(self):
+        # Long enough to overflow a recursive search
+        n = 5000
+        table = [('s{}'.format(i), ['s{}'.format(i + 1)])
+                 for i in range(n - 1)]
+        table.append(('s{}'.format(n - 1), ['s0', 'end']))
+        table.append(('end', []))
+        graph = build(table, ends=('end',))
+        self.assertEqual(graph.cycles(), [list(range(n))])
+
+    def test_nzsf(self):
+        sm = nzsfRecovery.build_state_machine(log=EventLog([]))
+        report = StateGraph(sm).check()
+        self.assertEqual(len(report['cycles']), 1)
+        cycle = report['cycles'][0]
+        self.assertIn('follow_on', cycle)
+        self.assertIn('follow_off', cycle)
+        self.assertNotIn('rec_success', cycle)
+        self.assertNotIn('rec_error', cycle)
+        for key in ('unknown', 'deadEnds', 'trapped', 'unreachable'):
+            self.assertEqual(report[key], [], key)
+
+class TestCheck(unittest.TestCase):
+    def assertCheckFails(self, graph, text):
+        with self.assertRaises(InitializationError) as ctx:
+            graph.check()
+        self.assertIn(text, ctx.exception.message)
+
+    def test_trapped(self):
+        # b and c loop forever without an exit
+        graph = build([('a', ['b', 'end']), ('b', ['c']), ('c', ['b']),
+                       ('end', [])], ends=('end',))
+        report = graph.analyze()
+        self.assertEqual(report['trapped'], ['b', 'c'])
+        self.assertEqual(report['cycles'], [['b', 'c']])
+        self.assertCheckFails(graph, 'States that never reach an End State: '
+                              'b, c')
+
+    def test_dead_end(self):
+        graph = build([('a', ['b', 'end']), ('b', []), ('end', [])],
+                      ends=('end',))
+        report = graph.analyze()
+        self.assertEqual(report['deadEnds'], ['b'])
+        self.assertEqual(report['trapped'], ['b'])
+        self.assertCheckFails(graph, 'States without transitions: b')
+
+    def test_unknown(self):
+        graph = build([('a', ['nowhere', 'end']), ('end', [])],
+                      ends=('end',))
+        self.assertEqual(graph.analyze()['unknown'], ['a -> nowhere'])
+        self.assertCheckFails(graph, 'Unknown target states: a -> nowhere')
+
+    def test_unreachable(self):
+        # Only a warning
+        graph = build([('a', ['end']), ('b', ['end']), ('end', [])],
+                      ends=('end',))
+        report = graph.check()
+        self.assertEqual(report['unreachable'], ['b'])
+
+    def test_validate(self):
+        sm = StateMachine(log=EventLog([]))
+        for name, targets, ss, es in (('a', ['b'], True, False),
+                                      ('b', ['b'], False, False),
+                                      ('end', [], False, True)):
+            s = State(name, None, [[t, [], 'True', False, '']
+                                   for t in targets], ss, es)
+            s.init_transitions()
+            sm.add_state(s)
+        with self.assertRaises(InitializationError):
+            sm.validate()
+
+if __name__ == '__main__':
+    unittest.main()